@@ -0,0 +1,151 @@
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Reproducible micro-benchmarks of the timetable pipeline on synthetic Wise TT
+# exports: parsing, session filters, rendering and sync diffing. Every case is
+# timed over several runs, then run once more under tracemalloc for its peak
+# memory. Run from the repository root:
+#
+#   python benchmarks/bench.py --sizes 1000,10000 --json before.json
+#   python benchmarks/bench.py --sizes 1000,10000 --compare before.json
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+_tmp_dir = tempfile.TemporaryDirectory(prefix='wisecal-bench-')
+os.environ['WISECAL_DATA_DIR'] = _tmp_dir.name
+
+import synthetic_ics
+import wise_tt
+import wisecal_cron
+
+FORMAT = {
+    'DEFAULT': {'PR': {'title': '{course_abbr} {ctype_abbr}'}, 'VAJE': {'title': '{course_abbr} {ctype_abbr} ({groups})'}},
+}
+
+def _measure(fn, repeat: int) -> dict:
+    # fn is (setup, run): run(setup()) is timed, setup runs untimed before every run
+    setup, run = fn
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    try:
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'min': min(times), 'median': statistics.median(times), 'peak_bytes': peak}
+
+def _fresh_slot_cache(base_dir: pathlib.Path):
+    wise_tt._slot_cache = wise_tt.SlotCache(base_dir / 'slot_cache', size=32, disk_size=512)
+    wise_tt._classify_tail.cache_clear()
+    wise_tt._course_abbr.cache_clear()
+
+def _changed(slots, ratio: float):
+    # The same timetable with ratio of its sessions moved to another room
+    changed = list(slots)
+    for i in range(0, len(changed), max(1, int(1 / ratio))):
+        slot = changed[i]
+        changed[i] = wise_tt.WiseSlot(slot.course, slot.course_abbr, slot.ctype, slot.ctype_abbr, slot.groups,
+                                      slot.location + 'X', slot.lecturer, slot.start_time, slot.end_time)
+    return changed
+
+def _synced_events(slots) -> dict:
+    # What a user's calendar holds after syncing slots, as gcal.load_synced_events returns it
+    events, hashes = wisecal_cron.RenderCache(slots).get(FORMAT)
+    return {event_id: (content_hash, None) for event_id, content_hash in hashes.items()}
+
+def cases(ical_path: pathlib.Path, work_dir: pathlib.Path, change_ratio: float) -> dict:
+    _fresh_slot_cache(work_dir / 'warm')
+    slots = wise_tt.get_slots(ical_path)
+    changed = _changed(slots, change_ratio)
+    synced = _synced_events(slots)
+    diff = wise_tt.diff_slots(slots, changed)
+    runs = itertools.count()
+    return {
+        # Cold: empty slot cache and classifier caches, every run in its own cache directory
+        'get_slots (cold)': (lambda: _fresh_slot_cache(work_dir / f'cold-{next(runs)}'), lambda _: wise_tt.get_slots(ical_path)),
+        'get_slots (disk cache)': (lambda: wise_tt._slot_cache._entries.clear(), lambda _: wise_tt.get_slots(ical_path)),
+        'get_slots (memory cache)': (lambda: None, lambda _: wise_tt.get_slots(ical_path)),
+        'get_session_filters': (lambda: None, lambda _: wise_tt.get_session_filters(slots)),
+        'WiseSlot.to_gcal': (lambda: None, lambda _: [slot.to_gcal(FORMAT) for slot in slots]),
+        'FormatPlan.render_all': (lambda: None, lambda _: wise_tt.FormatPlan(FORMAT).render_all(slots)),
+        'diff_slots': (lambda: None, lambda _: wise_tt.diff_slots(slots, changed)),
+        # Rendering included, as in a sync without a cached render
+        'plan_sync (full)': (lambda: wisecal_cron.RenderCache(changed),
+                             lambda cache: wisecal_cron.plan_sync(synced, cache, FORMAT)),
+        'plan_sync (incremental)': (lambda: wisecal_cron.RenderCache(changed, diff),
+                                    lambda cache: wisecal_cron.plan_sync(synced, cache, FORMAT, diff)),
+    }
+
+def run(sizes, repeat: int, seed: int, fallback_ratio: float, change_ratio: float) -> list:
+    results = []
+    work_dir = pathlib.Path(_tmp_dir.name)
+    for events in sizes:
+        # Large faculties have more courses and groups, not longer semesters
+        courses = max(20, events // 60)
+        groups = max(12, courses // 2)
+        ical_path = work_dir / f'synthetic-{events}.ics'
+        with open(ical_path, 'wb') as fh:
+            synthetic_ics.generate(fh, events=events, courses=courses, groups=groups, fallback_ratio=fallback_ratio, seed=seed)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # The parser prints a warning for every fallback event
+            for name, fn in cases(ical_path, work_dir, change_ratio).items():
+                result = {'case': name, 'events': events, **_measure(fn, repeat)}
+                results.append(result)
+                print(_format_row(result), file=sys.__stdout__, flush=True)
+    return results
+
+def _format_row(result: dict, baseline: dict = None) -> str:
+    row = f"{result['case']:<26} {result['events']:>8} {result['median'] * 1000:>11.2f} {result['min'] * 1000:>11.2f} {result['peak_bytes'] / 2**20:>10.2f}"
+    if baseline is not None:
+        row += f" {result['median'] / baseline['median']:>8.2f}x"
+    return row
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the WiseCal timetable pipeline on synthetic timetables')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma separated event counts')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fallback-ratio', type=float, default=0.02)
+    parser.add_argument('--change-ratio', type=float, default=0.05, help='Share of sessions changed between timetable versions')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare medians with')
+    args = parser.parse_args()
+
+    print(f"{'case':<26} {'events':>8} {'median ms':>11} {'min ms':>11} {'peak MiB':>10}")
+    results = run([int(size) for size in args.sizes.split(',')], args.repeat, args.seed, args.fallback_ratio, args.change_ratio)
+
+    if args.compare:
+        with open(args.compare, 'r') as fh:
+            baseline = {(r['case'], r['events']): r for r in json.load(fh)['results']}
+        print(f"\nCompared with {args.compare}:")
+        for result in results:
+            if (result['case'], result['events']) in baseline:
+                print(_format_row(result, baseline[(result['case'], result['events'])]))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({
+                'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'args': vars(args),
+                'results': results,
+            }, fh, indent=2)
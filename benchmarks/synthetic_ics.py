@@ -0,0 +1,123 @@
+import argparse
+import datetime
+import random
+import sys
+
+# Synthetic Wise TT exports. Events look like the real ones: SUMMARY is the
+# course, DESCRIPTION is "course, type, lecturers..., groups..." with escaped
+# commas and folded lines, and the same courses, rooms and description tails
+# repeat over the weeks of a semester.
+
+# DESCRIPTION tails after course and type, by name. L is a lecturer with a
+# title, P one without, G a group, K a group recognised by a keyword only.
+SHAPES = {
+    'lecturer_group': 'L G',
+    'two_lecturers': 'L L G',
+    'untitled_lecturer': 'P G',
+    'mixed_lecturers': 'L P G G',
+    'many_groups': 'L G G G G',
+    'keyword_group': 'L K G',
+}
+DEFAULT_SHAPES = ('lecturer_group', 'two_lecturers', 'untitled_lecturer', 'many_groups')
+
+_WORDS = ['spletne', 'tehnologije', 'podatkovne', 'baze', 'računalniška', 'grafika', 'operacijski', 'sistemi',
+          'matematika', 'statistika', 'algoritmi', 'omrežja', 'varnost', 'programiranje', 'načrtovanje', 'analiza']
+_FIRST_NAMES = ['Janez', 'Ana', 'Miha', 'Eva', 'Marko', 'Nina', 'Luka', 'Maja', 'Rok', 'Petra']
+_LAST_NAMES = ['Novak', 'Horvat', 'Kranjc', 'Zupan', 'Kos', 'Potočnik', 'Mlakar', 'Vidmar', 'Golob', 'Turk']
+_TITLES = ['dr.', 'prof. dr.', 'doc. dr.', 'asist.']
+_PROGRAMMES = ['RIT', 'ITK', 'MED', 'ELE']
+_KEYWORD_GROUPS = ['ERASMUS', 'izb. skupina', 'SK']
+_TYPES = ['PR', 'RV', 'SV', 'LV']
+
+def _fold(line: str) -> list:
+    # RFC 5545 folding at 75 octets, which may split UTF-8 sequences like Wise TT does
+    data = line.encode('utf-8')
+    lines = [data[:75]]
+    for i in range(75, len(data), 74):
+        lines.append(b' ' + data[i:i + 74])
+    return lines
+
+def _escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+
+def generate(out, events: int = 1000, courses: int = 20, groups: int = 12, shapes=DEFAULT_SHAPES,
+             fallback_ratio: float = 0.02, seed: int = 0, start: datetime.date = datetime.date(2025, 10, 1)):
+    # Writes an ICS with the given number of events to the binary file object out
+    rng = random.Random(seed)
+    course_names = []
+    while len(course_names) < courses:
+        name = ' '.join(rng.sample(_WORDS, rng.randint(1, 3))).capitalize()
+        name = f"{name} {len(course_names) + 1}" if name in course_names else name
+        course_names.append(name)
+    group_names = [f"{'UN' if i % 3 else 'MAG'} {i % 3 + 1} {_PROGRAMMES[i % len(_PROGRAMMES)]}" +
+                   (f" {rng.choice(['RV', 'VS'])} {i}" if i >= len(_PROGRAMMES) else '') for i in range(groups)]
+    lecturers = [f"{rng.choice(_FIRST_NAMES)} {rng.choice(_LAST_NAMES)}" for _ in range(max(4, courses))]
+
+    # Every course has a fixed set of sessions (type, lecturers, groups, room,
+    # weekday, hour) repeated weekly, like a real semester
+    sessions = []
+    for course in course_names:
+        course_lecturers = rng.sample(lecturers, 2)
+        for _ in range(rng.randint(2, 6)):
+            tail = []
+            for token in SHAPES[rng.choice(shapes)].split():
+                if token == 'L':
+                    tail.append(f"{rng.choice(_TITLES)} {rng.choice(course_lecturers)}")
+                elif token == 'P':
+                    tail.append(rng.choice(course_lecturers))
+                elif token == 'K':
+                    tail.append(rng.choice(_KEYWORD_GROUPS))
+                else:
+                    tail.append(rng.choice(group_names))
+            sessions.append((course, rng.choice(_TYPES), tail, f"G{rng.randint(1, 4)}-{rng.randint(1, 30)}",
+                             rng.randint(0, 4), rng.randint(7, 18)))
+
+    lines = [b'BEGIN:VCALENDAR', b'VERSION:2.0', b'PRODID:-//WiseCal//Synthetic Wise TT export//SL']
+    for i in range(events):
+        course, ctype, tail, location, weekday, hour = sessions[i % len(sessions)]
+        week = i // len(sessions)
+        day = start + datetime.timedelta(weeks=week, days=weekday - start.weekday())
+        begin = datetime.datetime.combine(day, datetime.time(hour))
+        end = begin + datetime.timedelta(hours=rng.choice([1, 2, 3]))
+        description = [course.upper() if rng.random() < 0.3 else course, ctype] + tail
+        if rng.random() < fallback_ratio:
+            # Too few parts, parsed as a fallback slot
+            description = description[:3]
+        event = [
+            'BEGIN:VEVENT',
+            f"UID:{i}-{seed}@wise-tt.synthetic",
+            'DTSTAMP:20250901T000000Z',
+            f"SUMMARY:{_escape(course)}",
+            f"DESCRIPTION:{_escape(', '.join(description))}",
+            f"LOCATION:{_escape(location)}",
+            f"DTSTART;TZID=Europe/Ljubljana:{begin:%Y%m%dT%H%M%S}",
+            f"DTEND;TZID=Europe/Ljubljana:{end:%Y%m%dT%H%M%S}",
+            'END:VEVENT',
+        ]
+        for line in event:
+            lines.extend(_fold(line))
+    lines.append(b'END:VCALENDAR')
+    out.write(b'\r\n'.join(lines) + b'\r\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic Wise TT ICS export')
+    parser.add_argument('output', help='ICS file to write, - for stdout')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--courses', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=12)
+    parser.add_argument('--shapes', default=','.join(DEFAULT_SHAPES), help=f"Comma separated DESCRIPTION shapes out of: {', '.join(SHAPES)}")
+    parser.add_argument('--fallback-ratio', type=float, default=0.02, help='Share of events with a DESCRIPTION that needs the fallback parser')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    shapes = args.shapes.split(',')
+    for shape in shapes:
+        if shape not in SHAPES:
+            parser.error(f"Unknown shape: {shape}")
+    kwargs = dict(events=args.events, courses=args.courses, groups=args.groups, shapes=shapes,
+                  fallback_ratio=args.fallback_ratio, seed=args.seed)
+    if args.output == '-':
+        generate(sys.stdout.buffer, **kwargs)
+    else:
+        with open(args.output, 'wb') as fh:
+            generate(fh, **kwargs)
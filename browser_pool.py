@@ -0,0 +1,130 @@
+from playwright.sync_api import sync_playwright
+from concurrent.futures import Future
+import threading
+import logging
+import queue
+import os
+
+logger = logging.getLogger(__name__)
+
+# Playwright's sync API is bound to the thread that started it, so every
+# pool worker owns its own Playwright instance and browser. Callers submit
+# work and get a fresh, isolated browser context for the duration of the task.
+POOL_SIZE = int(os.getenv('WISECAL_BROWSER_POOL_SIZE', '2'))
+# Browsers are recycled after this many tasks to contain leaked pages/memory
+MAX_USES_PER_BROWSER = int(os.getenv('WISECAL_BROWSER_MAX_USES', '100'))
+
+class BrowserPool:
+    def __init__(self, size: int = POOL_SIZE, max_uses: int = MAX_USES_PER_BROWSER):
+        self.size = max(1, size)
+        self.max_uses = max_uses
+        self._tasks = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._idle = 0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        # fn is called as fn(context, *args, **kwargs) on a pool worker
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Browser pool is shut down')
+            self._workers = [w for w in self._workers if w.is_alive()]
+            # Start another browser only when every existing one is busy
+            if len(self._workers) < self.size and self._idle <= self._tasks.qsize():
+                worker = threading.Thread(target=self._worker, name=f'browser-pool-{len(self._workers)}', daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(self._workers)
+        for _ in workers:
+            self._tasks.put(None)
+        if wait:
+            for w in workers:
+                w.join()
+
+    def _worker(self):
+        playwright = None
+        browser = None
+        uses = 0
+
+        def close_browser():
+            nonlocal browser
+            if browser is not None:
+                try:
+                    browser.close()
+                except Exception as e:
+                    logger.debug(f"Error closing browser: {e}")
+                browser = None
+
+        try:
+            while True:
+                with self._lock:
+                    self._idle += 1
+                item = self._tasks.get()
+                with self._lock:
+                    self._idle -= 1
+                if item is None:
+                    break
+                future, fn, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if playwright is None:
+                        playwright = sync_playwright().start()
+                    # Restart crashed browsers and recycle ones that served too many tasks
+                    if browser is not None and (not browser.is_connected() or uses >= self.max_uses):
+                        logger.debug(f"Restarting browser after {uses} uses (connected: {browser.is_connected()})")
+                        close_browser()
+                    if browser is None:
+                        browser = playwright.chromium.launch(headless=True)
+                        uses = 0
+                    uses += 1
+                    context = browser.new_context(accept_downloads=True)
+                    try:
+                        result = fn(context, *args, **kwargs)
+                    finally:
+                        try:
+                            context.close()
+                        except Exception as e:
+                            # A context that cannot be closed means the browser is in a bad state
+                            logger.debug(f"Error closing browser context: {e}")
+                            close_browser()
+                    future.set_result(result)
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            close_browser()
+            if playwright is not None:
+                try:
+                    playwright.stop()
+                except Exception as e:
+                    logger.debug(f"Error stopping playwright: {e}")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> BrowserPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._closed:
+            _pool = BrowserPool()
+        return _pool
+
+def shutdown_pool(wait: bool = True):
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
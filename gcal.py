@@ -1,13 +1,28 @@
 import os
 import pathlib
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient import discovery_cache
 from googleapiclient.errors import HttpError
-import yaml
 import datetime
 import zoneinfo
+import collections
+import copy
+import functools
+import threading
+import json
+import logging
+import random
+import time
+import httplib2
+import google_auth_httplib2
+import http_pool
+import metrics
+import storage
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 BASE_DATA_DIR = pathlib.Path(os.getenv('WISECAL_DATA_DIR', './wc_data'))
 
@@ -15,36 +30,314 @@ SCOPES = ['openid',
           'https://www.googleapis.com/auth/userinfo.email',
           'https://www.googleapis.com/auth/calendar.app.created']
 
+# Per-user state lives in files (default) or a SQLite database, see storage.py
+store = storage.open_store(BASE_DATA_DIR)
+
 def ensure_dirs():
-    (BASE_DATA_DIR / 'credentials').mkdir(parents=True, exist_ok=True)
-    (BASE_DATA_DIR / 'cal_ids').mkdir(parents=True, exist_ok=True)
-    (BASE_DATA_DIR / 'synced_events').mkdir(parents=True, exist_ok=True)
-    (BASE_DATA_DIR / 'settings').mkdir(parents=True, exist_ok=True)
+    BASE_DATA_DIR.mkdir(parents=True, exist_ok=True)
     (BASE_DATA_DIR / 'calendars').mkdir(parents=True, exist_ok=True)
+    store.ensure()
+
+def transaction():
+    # Groups several state writes, atomic with the SQLite backend
+    return store.transaction()
+
+SERVICE_CACHE_SIZE = int(os.getenv('WISECAL_SERVICE_CACHE_SIZE', '512'))
+SERVICE_CACHE_TTL = int(os.getenv('WISECAL_SERVICE_CACHE_TTL', '3600'))  # seconds
+
+# Per-user credentials and Calendar service objects, rebuilt when the
+# credentials stop being valid (i.e. on refresh) or the entry gets too old
+_ServiceEntry = collections.namedtuple('_ServiceEntry', ['creds', 'service', 'created'])
+_service_cache = collections.OrderedDict()
+_service_cache_lock = threading.Lock()
+
+@functools.cache
+def _calendar_discovery() -> dict:
+    # The discovery document bundled with googleapiclient, parsed once per process
+    return json.loads(discovery_cache.get_static_doc('calendar', 'v3'))
+
+def _cached_entry(user: str) -> _ServiceEntry | None:
+    with _service_cache_lock:
+        entry = _service_cache.get(user)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > SERVICE_CACHE_TTL or not entry.creds.valid:
+            del _service_cache[user]
+            return None
+        _service_cache.move_to_end(user)
+        return entry
 
-def get_cal_service(user: str):
-    creds_fn = BASE_DATA_DIR / 'credentials' / f'{user}.json'
-    if not creds_fn.exists():
-        raise FileNotFoundError(f'No credentials file found for user {user} at {creds_fn}')
-    creds = Credentials.from_authorized_user_file(str(creds_fn), scopes=SCOPES)
+def _cache_entry(user: str, entry: _ServiceEntry):
+    with _service_cache_lock:
+        _service_cache[user] = entry
+        _service_cache.move_to_end(user)
+        while len(_service_cache) > SERVICE_CACHE_SIZE:
+            _service_cache.popitem(last=False)
+
+def invalidate_service(user: str):
+    with _service_cache_lock:
+        _service_cache.pop(user, None)
+
+def get_credentials(user: str) -> Credentials:
+    entry = _cached_entry(user)
+    if entry is not None:
+        return entry.creds
+    creds_data = store.load_credentials(user)
+    if creds_data is None:
+        raise FileNotFoundError(f'No credentials found for user {user}')
+    creds = Credentials.from_authorized_user_info(json.loads(creds_data), scopes=SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(http_pool.auth_request)
         else:
             raise ValueError(f'Credentials for user {user} are invalid and cannot be refreshed.')
-        with open(creds_fn, 'w') as token:
-            token.write(creds.to_json())
-    
-    service = build('calendar', 'v3', credentials=creds)
+        store.save_credentials(user, creds.to_json())
+    _cache_entry(user, _ServiceEntry(creds, None, time.monotonic()))
+    return creds
+
+def _authorized_http(creds: Credentials):
+    # All users share http_pool's keep-alive connections to googleapis.com
+    return google_auth_httplib2.AuthorizedHttp(creds, http=http_pool.PooledHttp())
+
+def get_cal_service(user: str, creds: Credentials = None):
+    if creds is None:
+        creds = get_credentials(user)
+    entry = _cached_entry(user)
+    if entry is not None and entry.creds is creds and entry.service is not None:
+        return entry.service
+    service = build_from_document(_calendar_discovery(), http=_authorized_http(creds))
+    _cache_entry(user, _ServiceEntry(creds, service, entry.created if entry is not None and entry.creds is creds else time.monotonic()))
     return service
 
-def get_cal_id(user: str) -> str:
-    cal_id_fn = BASE_DATA_DIR / 'cal_ids' / f'{user}.txt'
-    if not cal_id_fn.exists():
+BATCH_SIZE = 50  # Google Calendar API limit of calls per batch request
+BATCH_WORKERS = int(os.getenv('WISECAL_BATCH_WORKERS', '8'))
+BATCH_MAX_RETRIES = int(os.getenv('WISECAL_BATCH_MAX_RETRIES', '5'))
+BATCH_BACKOFF_BASE = 1.0  # seconds
+BATCH_BACKOFF_MAX = 32.0  # seconds
+_RATE_LIMIT_REASONS = ('ratelimitexceeded', 'userratelimitexceeded', 'quotaexceeded')
+
+# Shared by all users so the total number of in-flight batch requests stays bounded
+_batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='gcal-batch')
+
+BatchOutcome = collections.namedtuple('BatchOutcome', ['key', 'response', 'exception'])
+
+_batch_seconds = metrics.Histogram('wisecal_gcal_batch_seconds', 'Google Calendar API batch requests')
+_batch_items = metrics.Counter('wisecal_gcal_batch_items_total', 'Calls in Google Calendar API batches by HTTP method and status code, retries included', ['method', 'code'])
+
+def _pool_hosts(field):
+    return {(host,): counts[field] for host, counts in http_pool.stats()['hosts'].items()}
+
+# Keep-alive reuse of the shared pool, also used by token refreshes and Wise TT downloads
+metrics.Gauge('wisecal_http_pool_requests', 'Requests sent over the shared HTTP connection pool by host', ['host'], fn=lambda: _pool_hosts('requests'))
+metrics.Gauge('wisecal_http_pool_connections', 'Connections opened by the shared HTTP connection pool by host', ['host'], fn=lambda: _pool_hosts('connections'))
+metrics.Gauge('wisecal_http_pool_reused', 'Requests served on an already open connection by host', ['host'], fn=lambda: _pool_hosts('reused'))
+
+def _outcome_code(outcome) -> str:
+    if outcome.exception is None:
+        return '200'
+    if isinstance(outcome.exception, HttpError):
+        return str(outcome.exception.resp.status)
+    return 'error'
+
+def is_retryable(exception) -> bool:
+    if isinstance(exception, HttpError):
+        status = exception.resp.status
+        if status == 429 or status >= 500:
+            return True
+        # 403 is also used for permanent errors, only rate limits are worth retrying
+        return status == 403 and any(r in str(exception).lower().replace(' ', '') for r in _RATE_LIMIT_REASONS)
+    return isinstance(exception, (OSError, httplib2.HttpLib2Error))
+
+def _execute_batch(service, creds: Credentials, chunk):
+    outcomes = {}
+    def callback(request_id, response, exception):
+        key = chunk[int(request_id)][0]
+        outcomes[key] = BatchOutcome(key, response, exception)
+    batch = service.new_batch_http_request(callback=callback)
+    for i, (_, request) in enumerate(chunk):
+        batch.add(request, request_id=str(i))
+    with _batch_seconds.time():
+        batch.execute(http=_authorized_http(creds))
+    return outcomes
+
+def execute_batched(service, creds: Credentials, requests: list) -> dict:
+    # requests is a list of (key, HttpRequest). Runs them in concurrent batches of
+    # BATCH_SIZE, retries rate-limit and server errors with exponential backoff and
+    # jitter, and returns a BatchOutcome for every key.
+    outcomes = {}
+    pending = list(requests)
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        chunks = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+        futures = [_batch_pool.submit(_execute_batch, service, creds, chunk) for chunk in chunks]
+        retry = []
+        for future, chunk in zip(futures, chunks):
+            try:
+                results = future.result()
+            except Exception as e:
+                # The whole batch request failed, every call in it shares the error
+                results = {key: BatchOutcome(key, None, e) for key, _ in chunk}
+            for key, request in chunk:
+                outcome = results.get(key, BatchOutcome(key, None, RuntimeError('No response in batch')))
+                _batch_items.inc(method=request.method, code=_outcome_code(outcome))
+                if outcome.exception is not None and attempt < BATCH_MAX_RETRIES and is_retryable(outcome.exception):
+                    retry.append((key, request))
+                else:
+                    outcomes[key] = outcome
+        if not retry:
+            break
+        delay = min(BATCH_BACKOFF_MAX, BATCH_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+        logger.info(f"Retrying {len(retry)} calendar API calls in {delay:.1f}s (attempt {attempt + 1}/{BATCH_MAX_RETRIES})")
+        time.sleep(delay)
+        pending = retry
+    return outcomes
+
+def has_credentials(user: str) -> bool:
+    return store.load_credentials(user) is not None
+
+def save_credentials(user: str, creds_json: str):
+    store.save_credentials(user, creds_json)
+    invalidate_service(user)
+
+def _timetable_key(settings: dict):
+    calendar = settings.get('calendar', {})
+    if not calendar.get('enabled', False):
         return None
-    with open(cal_id_fn, 'r') as fh:
-        cal_id = fh.read().strip()
-    return cal_id
+    timetable = calendar.get('timetable', {})
+    return (timetable.get('schoolcode'), timetable.get('filterId'))
+
+class SettingsIndex:
+    # Settings of every user, reloaded only for users whose settings changed
+    # according to the store's change tokens (file mtime/size or row version),
+    # with an inverted index from (schoolcode, filterId) to enabled owners.
+    # Cached settings are shared, callers must not modify them.
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._settings = {}
+        self._keys = {}
+        self._owners = {}
+
+    def _drop(self, owner: str):
+        self._tokens.pop(owner, None)
+        self._settings.pop(owner, None)
+        key = self._keys.pop(owner, None)
+        if key is not None:
+            owners = self._owners[key]
+            owners.discard(owner)
+            if not owners:
+                del self._owners[key]
+
+    def _load(self, owner: str, token) -> dict | None:
+        # The token is read before the settings, a concurrent write can only cause another reload
+        settings = self.store.load_settings(owner)
+        self._drop(owner)
+        if settings is None:
+            return None
+        self._tokens[owner] = token
+        self._settings[owner] = settings
+        key = _timetable_key(settings)
+        if key is not None:
+            self._keys[owner] = key
+            self._owners.setdefault(key, set()).add(owner)
+        return settings
+
+    def get(self, owner: str) -> dict | None:
+        token = self.store.settings_token(owner)
+        with self._lock:
+            if token is None:
+                self._drop(owner)
+                return None
+            if self._tokens.get(owner) != token:
+                return self._load(owner, token)
+            return self._settings[owner]
+
+    def invalidate(self, owner: str):
+        with self._lock:
+            self._drop(owner)
+
+    def refresh(self) -> int:
+        tokens = self.store.settings_tokens()
+        with self._lock:
+            for owner in self._tokens.keys() - tokens.keys():
+                self._drop(owner)
+            changed = [owner for owner, token in tokens.items() if self._tokens.get(owner) != token]
+            for owner in changed:
+                self._load(owner, tokens[owner])
+        return len(changed)
+
+    def timetables(self) -> dict:
+        # {(schoolcode, filterId): {owner: settings}} for all enabled calendars
+        reloaded = self.refresh()
+        logger.debug(f"Settings index refreshed, {reloaded} users reloaded")
+        with self._lock:
+            return {key: {owner: self._settings[owner] for owner in sorted(owners)} for key, owners in self._owners.items()}
+
+settings_index = SettingsIndex(store)
+
+def load_settings(user: str) -> dict | None:
+    settings = settings_index.get(user)
+    return copy.deepcopy(settings) if settings is not None else None
+
+STATUS_TTL = float(os.getenv('WISECAL_STATUS_TTL', '60'))  # seconds
+
+class UserStatusCache:
+    # What the dashboard shows per user: whether they have settings, whether
+    # syncing is enabled and when their calendar was last updated. Settings
+    # writes and syncs in this process update entries in place, entries are
+    # reloaded from the store after ttl to pick up standalone workers' syncs.
+    def __init__(self, ttl: float = STATUS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+
+    def get(self, user: str) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user)
+            if entry is not None and now - entry[0] < self.ttl:
+                return dict(entry[1])
+            generation = self._generation
+        settings = settings_index.get(user)
+        status = {
+            'has_settings': settings is not None,
+            'enabled': settings is not None and settings.get('calendar', {}).get('enabled', False),
+            'last_update': store.get_last_update(user),
+        }
+        with self._lock:
+            # Not cached when an update came in while loading, it may be newer than what was read
+            if generation == self._generation:
+                self._entries[user] = (now, status)
+        return dict(status)
+
+    def update(self, user: str, **fields):
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.get(user)
+            if entry is not None:
+                entry[1].update(fields)
+
+user_status = UserStatusCache()
+
+def save_settings(user: str, settings: dict):
+    store.save_settings(user, settings)
+    settings_index.invalidate(user)
+    user_status.update(user, has_settings=True, enabled=settings.get('calendar', {}).get('enabled', False))
+
+def request_sync(user: str):
+    # Queues a sync of this user's calendar only, see wisecal_cron.sync_user
+    store.request_sync(user)
+
+def pending_syncs() -> dict:
+    # {user: request time}
+    return store.pending_syncs()
+
+def complete_sync(user: str, requested: float):
+    store.complete_sync(user, requested)
+
+def get_cal_id(user: str) -> str:
+    return store.get_cal_id(user)
 
 def create_calendar(user: str, name: str):
     service = get_cal_service(user)
@@ -54,9 +347,7 @@ def create_calendar(user: str, name: str):
     }
     created_cal = service.calendars().insert(body=calendar).execute()
     cal_id = created_cal['id']
-    cal_id_fn = BASE_DATA_DIR / 'cal_ids' / f'{user}.txt'
-    with open(cal_id_fn, 'w') as fh:
-        fh.write(cal_id)
+    store.set_cal_id(user, cal_id)
     return cal_id
 
 def check_calendar_exists(user: str, cal_id: str) -> bool:
@@ -71,54 +362,54 @@ def check_calendar_exists(user: str, cal_id: str) -> bool:
             raise
 
 def delete_calendar_id(user: str):
-    cal_id_fn = BASE_DATA_DIR / 'cal_ids' / f'{user}.txt'
-    if cal_id_fn.exists():
-        cal_id_fn.unlink()
+    store.delete_cal_id(user)
 
 def set_calendar_enabled(user: str, enabled: bool):
-    settings_fn = BASE_DATA_DIR / 'settings' / f'{user}.yaml'
-    if not settings_fn.exists():
-        raise FileNotFoundError(f'No settings file found for user {user} at {settings_fn}')
-    with open(settings_fn, 'r') as fh:
-        settings = yaml.safe_load(fh)
-    settings.setdefault('calendar', {})['enabled'] = enabled
-    with open(settings_fn, 'w') as fh:
-        yaml.safe_dump(settings, fh)
+    with store.transaction():
+        settings = store.load_settings(user)
+        if settings is None:
+            raise FileNotFoundError(f'No settings found for user {user}')
+        settings.setdefault('calendar', {})['enabled'] = enabled
+        save_settings(user, settings)
 
 def get_calendar_enabled(user: str) -> bool:
-    settings_fn = BASE_DATA_DIR / 'settings' / f'{user}.yaml'
-    if not settings_fn.exists():
-        raise FileNotFoundError(f'No settings file found for user {user} at {settings_fn}')
-    with open(settings_fn, 'r') as fh:
-        settings = yaml.safe_load(fh)
+    settings = settings_index.get(user)
+    if settings is None:
+        raise FileNotFoundError(f'No settings found for user {user}')
     return settings.get('calendar', {}).get('enabled', False)
 
+def load_synced_events(user: str) -> dict:
+    # {event ID: (content hash, etag)}, both None for events synced before they were recorded
+    return store.load_synced_events(user)
+
 def load_synced_event_ids(user: str) -> list[str]:
-    synced_events_fn = BASE_DATA_DIR / 'synced_events' / f'{user}.txt'
-    if not synced_events_fn.exists():
-        return []
-    with open(synced_events_fn, 'r') as fh:
-        event_ids = [line.strip() for line in fh if line.strip()]
-    return event_ids
+    return list(store.load_synced_events(user))
 
 _LJUBLJANA_TZ = zoneinfo.ZoneInfo('Europe/Ljubljana')
 def get_last_update_time(user: str) -> datetime.datetime | None:
-    update_fn = BASE_DATA_DIR / 'synced_events' / f'{user}_last_update.txt'
-    if not update_fn.exists():
+    timestamp = store.get_last_update(user)
+    if timestamp is None:
         return None
-    with open(update_fn, 'r') as fh:
-        timestamp = float(fh.read().strip())
     return datetime.datetime.fromtimestamp(timestamp, _LJUBLJANA_TZ)
 
+def get_user_status(user: str) -> dict:
+    # Cached, see UserStatusCache
+    status = user_status.get(user)
+    timestamp = status.pop('last_update')
+    status['last_update_time'] = datetime.datetime.fromtimestamp(timestamp, _LJUBLJANA_TZ) if timestamp is not None else None
+    return status
+
 def set_last_update_time(user: str, timestamp: float = None):
     if timestamp is None:
         timestamp = datetime.datetime.now(_LJUBLJANA_TZ).timestamp()
-    update_fn = BASE_DATA_DIR / 'synced_events' / f'{user}_last_update.txt'
-    with open(update_fn, 'w') as fh:
-        fh.write(str(timestamp))
-
-def save_synced_event_ids(user: str, events: list[str]):
-    synced_events_fn = BASE_DATA_DIR / 'synced_events' / f'{user}.txt'
-    with open(synced_events_fn, 'w') as fh:
-        for event_id in events:
-            fh.write(f'{event_id}\n')
+    store.set_last_update(user, timestamp)
+    user_status.update(user, last_update=timestamp)
+
+def get_synced_timetable(user: str) -> str | None:
+    return store.get_synced_timetable(user)
+
+def set_synced_timetable(user: str, digest: str | None):
+    store.set_synced_timetable(user, digest)
+
+def save_synced_events(user: str, events: dict):
+    store.save_synced_events(user, events)
@@ -0,0 +1,86 @@
+import os
+import threading
+import http.cookiejar
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import Request
+
+POOL_HOSTS = int(os.getenv('WISECAL_HTTP_POOL_HOSTS', '8'))
+POOL_CONNECTIONS_PER_HOST = int(os.getenv('WISECAL_HTTP_POOL_CONNECTIONS', '32'))
+TIMEOUT = 60  # seconds
+
+# One keep-alive connection pool for every outgoing request, shared by all
+# users' Google API transports, token refreshes and Wise TT downloads
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_CONNECTIONS_PER_HOST)
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
+# The session is shared between users, so it must never carry cookies
+session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+if os.getenv('WISECAL_CA_BUNDLE'):
+    # e.g. a local HTTPS stand-in for googleapis.com; requests would otherwise
+    # prefer REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE from the environment
+    session.verify = os.getenv('WISECAL_CA_BUNDLE')
+    session.trust_env = False
+
+# google.auth transport request for token refreshes and ID token checks
+auth_request = Request(session=session)
+
+class PooledHttp:
+    # httplib2.Http-compatible transport for googleapiclient and
+    # google_auth_httplib2.AuthorizedHttp, backed by the shared pool.
+    # Unlike httplib2.Http it is safe to use from several threads.
+    redirect_codes = frozenset((300, 301, 302, 303, 307, 308))
+    follow_redirects = True
+
+    def __init__(self, timeout: float = TIMEOUT):
+        self.timeout = timeout
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        try:
+            response = session.request(
+                method, uri, data=body, headers=headers, timeout=self.timeout,
+                allow_redirects=self.follow_redirects and redirections > 0 and method in ('GET', 'HEAD'),
+            )
+        except requests.Timeout as e:
+            raise TimeoutError(str(e)) from e
+        except requests.ConnectionError as e:
+            raise ConnectionError(str(e)) from e
+        info = {k.lower(): v for k, v in response.headers.items()}
+        # Content is already decoded by requests
+        info.pop('content-encoding', None)
+        info.pop('content-length', None)
+        info['status'] = str(response.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = response.reason
+        return resp, response.content
+
+    def close(self):
+        # Connections belong to the shared pool and stay open
+        pass
+
+_stats_lock = threading.Lock()
+
+def stats() -> dict:
+    # Connection reuse across all hosts: requests served vs. connections opened
+    with _stats_lock:
+        pools = _adapter.poolmanager.pools
+        hosts = {}
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+                'reused': pool.num_requests - pool.num_connections,
+            }
+    total_requests = sum(h['requests'] for h in hosts.values())
+    total_connections = sum(h['connections'] for h in hosts.values())
+    return {
+        'requests': total_requests,
+        'connections': total_connections,
+        'reused': total_requests - total_connections,
+        'hosts': hosts,
+    }
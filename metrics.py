@@ -0,0 +1,190 @@
+import http.server
+import contextlib
+import threading
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+# Minimal Prometheus metrics: counters, gauges and histograms with labels,
+# rendered in the text exposition format by render(). Values are per process.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # Unlabelled metrics are exported from the start, not only once used
+            self._values[()] = self._initial()
+        with _registry_lock:
+            if any(metric.name == name for metric in _registry):
+                raise ValueError(f'Duplicate metric: {name}')
+            _registry.append(self)
+
+    def _initial(self):
+        return 0.0
+
+    def _key(self, labels) -> tuple:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        # (name suffix, ((label, value), ...), value)
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield '', tuple(zip(self.labelnames, key)), value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), fn=None, ttl: float = 0):
+        # fn, if given, is called on render for the value of an unlabelled gauge,
+        # or a {label values: value} dict of a labelled one, at most once every ttl seconds
+        self.fn = fn
+        self.ttl = ttl
+        self._collected = None
+        super().__init__(name, documentation, labelnames)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        if self.fn is None:
+            yield from super()._samples()
+            return
+        now = time.monotonic()
+        with self._lock:
+            collected = self._collected
+        if collected is None or now - collected[0] >= self.ttl:
+            try:
+                collected = (now, self.fn())
+            except Exception as e:
+                logger.warning(f"Failed to collect {self.name}: {e}")
+                return
+            with self._lock:
+                self._collected = collected
+        if not self.labelnames:
+            yield '', (), collected[1]
+            return
+        for key, value in sorted(collected[1].items()):
+            yield '', tuple(zip(self.labelnames, key)), value
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(b) for b in buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+
+    def _initial(self):
+        # [count per bucket, sum]
+        return [[0] * len(self.buckets), 0.0]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = self._initial()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        # Observes the duration of the block in seconds, also when it raises
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: ([*counts], total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', labels + (('le', _format_value(bound)),), cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    return ''.join(metric.render() for metric in metrics)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port: int, host: str = '0.0.0.0') -> http.server.ThreadingHTTPServer:
+    # /metrics on a port of its own, kept off the public web app
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
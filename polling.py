@@ -0,0 +1,126 @@
+import threading
+import collections
+import pathlib
+import logging
+import random
+import heapq
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = float(os.getenv('WISECAL_POLL_MIN_INTERVAL', '300'))  # seconds
+MAX_INTERVAL = float(os.getenv('WISECAL_POLL_MAX_INTERVAL', '7200'))  # seconds
+# Timetable downloads allowed per hour, manual triggers are not limited
+FETCH_BUDGET = int(os.getenv('WISECAL_POLL_BUDGET', '240'))
+# A timetable unchanged for some time is polled after a quarter of that time
+STABILITY_FACTOR = 0.25
+# Timetables that changed at least BUSY_CHANGES times in BUSY_WINDOW are
+# polled at least every BUSY_INTERVAL even when quiet for a while
+BUSY_CHANGES = 3
+BUSY_WINDOW = 7 * 24 * 3600  # seconds
+BUSY_INTERVAL = 1800  # seconds
+CHANGE_HISTORY = 10
+
+class Poller:
+    # Decides which timetables to download in a pass. Each (schoolcode, filterId)
+    # gets its next poll time from its own change history, due timetables are
+    # taken from a priority queue by how overdue they are, and the total number
+    # of downloads stays within the hourly budget. State is kept next to the
+    # timetable's ICS, so it survives restarts and moves with its shard.
+    def __init__(self, state_dir, min_interval: float = MIN_INTERVAL, max_interval: float = MAX_INTERVAL, budget: int = FETCH_BUDGET):
+        self.state_dir = pathlib.Path(state_dir)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.budget = budget
+        self._states = {}
+        self._triggered = set()
+        self._fetches = collections.deque()
+        self._lock = threading.Lock()
+
+    def _state_path(self, key):
+        schoolcode, filterId = key
+        return self.state_dir / f"{schoolcode}_{filterId}.poll.json"
+
+    def _state(self, key):
+        state = self._states.get(key)
+        if state is None:
+            try:
+                with open(self._state_path(key), 'r') as fh:
+                    state = json.load(fh)
+            except (FileNotFoundError, ValueError):
+                # Never polled, due right away
+                state = {'next_poll': 0, 'first_poll': None, 'digest': None, 'changes': [], 'failures': 0}
+            self._states[key] = state
+        return state
+
+    def _interval(self, state, now):
+        if state['failures']:
+            return min(self.max_interval, self.min_interval * 2 ** state['failures'])
+        changes = state['changes']
+        stable_for = now - (changes[-1] if changes else state['first_poll'])
+        interval = min(self.max_interval, max(self.min_interval, stable_for * STABILITY_FACTOR))
+        if sum(1 for t in changes if now - t < BUSY_WINDOW) >= BUSY_CHANGES:
+            interval = min(interval, max(self.min_interval, BUSY_INTERVAL))
+        # Spread timetables out so they do not all come due in the same pass
+        return interval * random.uniform(0.9, 1.1)
+
+    def trigger(self, key):
+        # Polls the timetable in the next pass, ahead of everything else
+        with self._lock:
+            self._triggered.add(key)
+
+    def due(self, keys, forced=()) -> list:
+        # Timetables to download now out of keys, most urgent first
+        now = time.time()
+        with self._lock:
+            keys = set(keys)
+            # State of timetables polled elsewhere in the meantime (other shards) is reloaded
+            for key in self._states.keys() - keys:
+                del self._states[key]
+            urgent = [key for key in keys if key in self._triggered or key in forced]
+            self._triggered.difference_update(urgent)
+            queue = []
+            for key in keys.difference(urgent):
+                next_poll = self._state(key)['next_poll']
+                if next_poll <= now:
+                    queue.append((next_poll, key))
+            heapq.heapify(queue)
+            while self._fetches and now - self._fetches[0] > 3600:
+                self._fetches.popleft()
+            # Manual and forced polls are neither limited by nor counted against the budget
+            budget_left = max(0, self.budget - len(self._fetches))
+            scheduled = []
+            while queue and budget_left > 0:
+                scheduled.append(heapq.heappop(queue)[1])
+                budget_left -= 1
+            if queue:
+                logger.info(f"Poll budget of {self.budget}/h used up, deferring {len(queue)} due timetables")
+            self._fetches.extend(now for _ in scheduled)
+            selected = urgent + scheduled
+        logger.debug(f"Polling {len(selected)} of {len(keys)} timetables")
+        return selected
+
+    def record(self, key, digest: str = None, failed: bool = False):
+        # Result of polling key: the content digest of the current timetable, or a failure
+        now = time.time()
+        with self._lock:
+            state = self._state(key)
+            if state['first_poll'] is None:
+                state['first_poll'] = now
+            if failed:
+                state['failures'] += 1
+            else:
+                state['failures'] = 0
+                if state['digest'] is not None and digest != state['digest']:
+                    state['changes'] = (state['changes'] + [now])[-CHANGE_HISTORY:]
+                state['digest'] = digest
+            state['next_poll'] = now + self._interval(state, now)
+            state = dict(state)
+        try:
+            with open(self._state_path(key), 'w') as fh:
+                json.dump(state, fh)
+        except OSError as e:
+            logger.warning(f"Failed to save poll state for {key}: {e}")
+        logger.debug(f"Next poll of {key} in {(state['next_poll'] - now) / 60:.0f} min")
@@ -0,0 +1,421 @@
+import contextlib
+import threading
+import pathlib
+import sqlite3
+import logging
+import json
+import sys
+import time
+import os
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Per-user state: OAuth credentials (JSON text), settings (dict), Google
+# calendar ID, synced event IDs, last update timestamp and the digest of the
+# timetable the calendar was last synced to.
+
+class FileStore:
+    # The original layout, one small file per user and kind of state
+    def __init__(self, base_dir):
+        self.base_dir = pathlib.Path(base_dir)
+
+    def ensure(self):
+        for name in ('credentials', 'cal_ids', 'synced_events', 'settings', 'sync_requests'):
+            (self.base_dir / name).mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Every file write stands on its own
+        yield
+
+    def _read(self, path):
+        if not path.exists():
+            return None
+        with open(path, 'r') as fh:
+            return fh.read()
+
+    def _write(self, path, data):
+        with open(path, 'w') as fh:
+            fh.write(data)
+
+    def load_credentials(self, user: str) -> str | None:
+        return self._read(self.base_dir / 'credentials' / f'{user}.json')
+
+    def save_credentials(self, user: str, data: str):
+        self._write(self.base_dir / 'credentials' / f'{user}.json', data)
+
+    def load_settings(self, user: str) -> dict | None:
+        data = self._read(self.base_dir / 'settings' / f'{user}.yaml')
+        return yaml.safe_load(data) if data is not None else None
+
+    def save_settings(self, user: str, settings: dict):
+        with open(self.base_dir / 'settings' / f'{user}.yaml', 'w') as fh:
+            yaml.safe_dump(settings, fh)
+
+    # Change tokens let callers cache settings and reload only what changed
+    def settings_token(self, user: str):
+        try:
+            st = os.stat(self.base_dir / 'settings' / f'{user}.yaml')
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def settings_tokens(self) -> dict:
+        tokens = {}
+        with os.scandir(self.base_dir / 'settings') as it:
+            for entry in it:
+                if entry.name.endswith('.yaml'):
+                    st = entry.stat()
+                    tokens[entry.name[:-len('.yaml')]] = (st.st_mtime_ns, st.st_size)
+        return tokens
+
+    def get_cal_id(self, user: str) -> str | None:
+        data = self._read(self.base_dir / 'cal_ids' / f'{user}.txt')
+        return data.strip() if data is not None else None
+
+    def set_cal_id(self, user: str, cal_id: str):
+        self._write(self.base_dir / 'cal_ids' / f'{user}.txt', cal_id)
+
+    def delete_cal_id(self, user: str):
+        (self.base_dir / 'cal_ids' / f'{user}.txt').unlink(missing_ok=True)
+
+    def load_synced_events(self, user: str) -> dict:
+        # One event per line: ID, or ID, content hash and etag separated by tabs
+        data = self._read(self.base_dir / 'synced_events' / f'{user}.txt')
+        if data is None:
+            return {}
+        events = {}
+        for line in data.splitlines():
+            event_id, _, rest = line.strip().partition('\t')
+            if event_id:
+                content_hash, _, etag = rest.partition('\t')
+                events[event_id] = (content_hash or None, etag or None)
+        return events
+
+    def save_synced_events(self, user: str, events: dict):
+        lines = []
+        for event_id, (content_hash, etag) in events.items():
+            if content_hash is None and etag is None:
+                lines.append(f'{event_id}\n')
+            else:
+                lines.append(f'{event_id}\t{content_hash or ""}\t{etag or ""}\n')
+        self._write(self.base_dir / 'synced_events' / f'{user}.txt', ''.join(lines))
+
+    def get_last_update(self, user: str) -> float | None:
+        data = self._read(self.base_dir / 'synced_events' / f'{user}_last_update.txt')
+        return float(data.strip()) if data is not None else None
+
+    def set_last_update(self, user: str, timestamp: float):
+        self._write(self.base_dir / 'synced_events' / f'{user}_last_update.txt', str(timestamp))
+
+    def get_synced_timetable(self, user: str) -> str | None:
+        data = self._read(self.base_dir / 'synced_events' / f'{user}_timetable.txt')
+        if data is None:
+            return None
+        return data.strip() or None
+
+    def set_synced_timetable(self, user: str, digest: str | None):
+        timetable_fn = self.base_dir / 'synced_events' / f'{user}_timetable.txt'
+        if digest is None:
+            timetable_fn.unlink(missing_ok=True)
+        else:
+            self._write(timetable_fn, digest)
+
+    # Pending per-user syncs, one file per user holding the request time
+    def request_sync(self, user: str, requested: float | None = None):
+        self._write(self.base_dir / 'sync_requests' / f'{user}.txt', str(requested or time.time()))
+
+    def pending_syncs(self) -> dict:
+        pending = {}
+        for request_fn in (self.base_dir / 'sync_requests').glob('*.txt'):
+            try:
+                with open(request_fn, 'r') as fh:
+                    pending[request_fn.stem] = float(fh.read().strip() or 0)
+            except (FileNotFoundError, ValueError):
+                continue
+        return pending
+
+    def complete_sync(self, user: str, requested: float):
+        # Requests made after the sync started stay pending
+        request_fn = self.base_dir / 'sync_requests' / f'{user}.txt'
+        data = self._read(request_fn)
+        if data is not None and float(data.strip() or 0) <= requested:
+            request_fn.unlink(missing_ok=True)
+
+    def users(self) -> set[str]:
+        users = set()
+        for name, pattern in (('credentials', '*.json'), ('settings', '*.yaml'), ('cal_ids', '*.txt')):
+            users.update(p.stem for p in (self.base_dir / name).glob(pattern))
+        for p in (self.base_dir / 'synced_events').glob('*.txt'):
+            if not p.stem.endswith(('_last_update', '_timetable')):
+                users.add(p.stem)
+        return users
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    credentials TEXT,
+    last_update REAL,
+    synced_timetable TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    owner TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    enabled INTEGER NOT NULL DEFAULT 0,
+    schoolcode TEXT,
+    filter_id TEXT,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS settings_timetable ON settings (enabled, schoolcode, filter_id);
+CREATE TABLE IF NOT EXISTS calendars (
+    owner TEXT PRIMARY KEY,
+    cal_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_requests (
+    owner TEXT PRIMARY KEY,
+    requested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS synced_events (
+    owner TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    content_hash TEXT,
+    etag TEXT,
+    PRIMARY KEY (owner, event_id)
+) WITHOUT ROWID;
+'''
+# Columns added after the table was first created: (table, column, definition)
+_ADDED_COLUMNS = (
+    ('settings', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('synced_events', 'content_hash', 'TEXT'),
+    ('synced_events', 'etag', 'TEXT'),
+)
+
+def _connect(path) -> sqlite3.Connection:
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Autocommit, transactions are managed explicitly
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+class SqliteStore:
+    # All state in one SQLite database in WAL mode, safe for concurrent
+    # access from the web workers and the sync job
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect(self.path)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def ensure(self):
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        for table, column, definition in _ADDED_COLUMNS:
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self._conn()
+        if self._local.depth > 0:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+    def _one(self, query, params):
+        row = self._conn().execute(query, params).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_user_field(self, user, field, value):
+        with self.transaction():
+            self._conn().execute(
+                f'INSERT INTO users (email, {field}) VALUES (?, ?) ON CONFLICT(email) DO UPDATE SET {field} = excluded.{field}',
+                (user, value))
+
+    def load_credentials(self, user: str) -> str | None:
+        return self._one('SELECT credentials FROM users WHERE email = ?', (user,))
+
+    def save_credentials(self, user: str, data: str):
+        self._set_user_field(user, 'credentials', data)
+
+    def load_settings(self, user: str) -> dict | None:
+        data = self._one('SELECT data FROM settings WHERE owner = ?', (user,))
+        return json.loads(data) if data is not None else None
+
+    def save_settings(self, user: str, settings: dict):
+        calendar = settings.get('calendar', {})
+        timetable = calendar.get('timetable', {})
+        with self.transaction():
+            self._conn().execute(
+                'INSERT INTO settings (owner, data, enabled, schoolcode, filter_id) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(owner) DO UPDATE SET data = excluded.data, enabled = excluded.enabled, '
+                'schoolcode = excluded.schoolcode, filter_id = excluded.filter_id, version = settings.version + 1',
+                (user, json.dumps(settings), int(bool(calendar.get('enabled', False))),
+                 timetable.get('schoolcode'), timetable.get('filterId')))
+
+    def settings_token(self, user: str):
+        return self._one('SELECT version FROM settings WHERE owner = ?', (user,))
+
+    def settings_tokens(self) -> dict:
+        return dict(self._conn().execute('SELECT owner, version FROM settings'))
+
+    def get_cal_id(self, user: str) -> str | None:
+        return self._one('SELECT cal_id FROM calendars WHERE owner = ?', (user,))
+
+    def set_cal_id(self, user: str, cal_id: str):
+        with self.transaction():
+            self._conn().execute('INSERT OR REPLACE INTO calendars (owner, cal_id) VALUES (?, ?)', (user, cal_id))
+
+    def delete_cal_id(self, user: str):
+        with self.transaction():
+            self._conn().execute('DELETE FROM calendars WHERE owner = ?', (user,))
+
+    def load_synced_events(self, user: str) -> dict:
+        rows = self._conn().execute('SELECT event_id, content_hash, etag FROM synced_events WHERE owner = ?', (user,))
+        return {event_id: (content_hash, etag) for event_id, content_hash, etag in rows}
+
+    def save_synced_events(self, user: str, events: dict):
+        with self.transaction():
+            conn = self._conn()
+            conn.execute('DELETE FROM synced_events WHERE owner = ?', (user,))
+            conn.executemany('INSERT OR IGNORE INTO synced_events (owner, event_id, content_hash, etag) VALUES (?, ?, ?, ?)',
+                             ((user, event_id, content_hash, etag) for event_id, (content_hash, etag) in events.items()))
+
+    def get_last_update(self, user: str) -> float | None:
+        return self._one('SELECT last_update FROM users WHERE email = ?', (user,))
+
+    def set_last_update(self, user: str, timestamp: float):
+        self._set_user_field(user, 'last_update', timestamp)
+
+    def get_synced_timetable(self, user: str) -> str | None:
+        return self._one('SELECT synced_timetable FROM users WHERE email = ?', (user,))
+
+    def set_synced_timetable(self, user: str, digest: str | None):
+        self._set_user_field(user, 'synced_timetable', digest)
+
+    def request_sync(self, user: str, requested: float | None = None):
+        with self.transaction():
+            self._conn().execute('INSERT OR REPLACE INTO sync_requests (owner, requested) VALUES (?, ?)', (user, requested or time.time()))
+
+    def pending_syncs(self) -> dict:
+        return dict(self._conn().execute('SELECT owner, requested FROM sync_requests'))
+
+    def complete_sync(self, user: str, requested: float):
+        with self.transaction():
+            self._conn().execute('DELETE FROM sync_requests WHERE owner = ? AND requested <= ?', (user, requested))
+
+    def users(self) -> set[str]:
+        conn = self._conn()
+        users = {row[0] for row in conn.execute('SELECT email FROM users')}
+        users.update(row[0] for row in conn.execute('SELECT owner FROM settings'))
+        users.update(row[0] for row in conn.execute('SELECT owner FROM calendars'))
+        users.update(row[0] for row in conn.execute('SELECT DISTINCT owner FROM synced_events'))
+        return users
+
+class LeaseTable:
+    # Named, expiring leases shared by all processes using the same data
+    # directory. Each statement is atomic, so at most one holder owns a lease
+    # until it is released or not renewed within its TTL.
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect(self.path)
+            conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        # Takes a free or expired lease, or extends one already held
+        now = time.time()
+        cursor = self._conn().execute(
+            'INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires '
+            'WHERE leases.holder = excluded.holder OR leases.expires < ?',
+            (name, holder, now + ttl, now))
+        return cursor.rowcount == 1
+
+    def renew(self, name: str, holder: str, ttl: float) -> bool:
+        cursor = self._conn().execute('UPDATE leases SET expires = ? WHERE name = ? AND holder = ?', (time.time() + ttl, name, holder))
+        return cursor.rowcount == 1
+
+    def release(self, name: str, holder: str):
+        self._conn().execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
+
+    def holders(self, prefix: str) -> dict:
+        # {name: holder} of unexpired leases whose name starts with prefix
+        rows = self._conn().execute('SELECT name, holder FROM leases WHERE substr(name, 1, ?) = ? AND expires >= ?',
+                                    (len(prefix), prefix, time.time()))
+        return dict(rows)
+
+def open_store(base_dir, backend: str = None):
+    backend = backend or os.getenv('WISECAL_STORAGE', 'files')
+    if backend == 'files':
+        return FileStore(base_dir)
+    if backend == 'sqlite':
+        return SqliteStore(pathlib.Path(base_dir) / 'wisecal.sqlite3')
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+def migrate(source, target):
+    # Copies every user's state from one store to another in a single transaction
+    source.ensure()
+    target.ensure()
+    users = sorted(source.users())
+    with target.transaction():
+        for user in users:
+            credentials = source.load_credentials(user)
+            if credentials is not None:
+                target.save_credentials(user, credentials)
+            settings = source.load_settings(user)
+            if settings is not None:
+                target.save_settings(user, settings)
+            cal_id = source.get_cal_id(user)
+            if cal_id is not None:
+                target.set_cal_id(user, cal_id)
+            target.save_synced_events(user, source.load_synced_events(user))
+            last_update = source.get_last_update(user)
+            if last_update is not None:
+                target.set_last_update(user, last_update)
+            target.set_synced_timetable(user, source.get_synced_timetable(user))
+        # Pending syncs keep their request time so workers complete them as usual
+        for user, requested in source.pending_syncs().items():
+            target.request_sync(user, requested)
+    return users
+
+if __name__ == '__main__':
+    # python storage.py migrate [files|sqlite] [files|sqlite]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print(f'Usage: {sys.argv[0]} migrate [SOURCE_BACKEND] [TARGET_BACKEND]')
+        sys.exit(1)
+    base_dir = pathlib.Path(os.getenv('WISECAL_DATA_DIR', './wc_data'))
+    source_backend = sys.argv[2] if len(sys.argv) > 2 else 'files'
+    target_backend = sys.argv[3] if len(sys.argv) > 3 else 'sqlite'
+    migrated = migrate(open_store(base_dir, source_backend), open_store(base_dir, target_backend))
+    logger.info(f'Migrated {len(migrated)} users from {source_backend} to {target_backend} in {base_dir}')
@@ -0,0 +1,121 @@
+import http.server
+import importlib
+import json
+import os
+import pathlib
+import ssl
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+os.environ['WISECAL_DATA_DIR'] = tempfile.mkdtemp(prefix='wisecal-test-')
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build_from_document
+import google_auth_httplib2
+
+import gcal
+import http_pool
+import metrics
+
+DATA_DIR = pathlib.Path(__file__).resolve().parent / 'data'
+# Self-signed for localhost and 127.0.0.1
+CERT = DATA_DIR / 'standin-cert.pem'
+KEY = DATA_DIR / 'standin-key.pem'
+
+class StandInGoogleAPI:
+    # Local HTTPS stand-in for the Calendar API: answers calendars.get with
+    # the calendar ID and the bearer token the request was made with
+    def __init__(self):
+        self.connections = 0
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                standin.connections += 1
+
+            def do_GET(self):
+                prefix = '/calendar/v3/calendars/'
+                path = self.path.split('?')[0]
+                if not path.startswith(prefix):
+                    self.send_error(404)
+                    return
+                body = json.dumps({
+                    'id': path[len(prefix):],
+                    'authorization': self.headers.get('Authorization'),
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(CERT, KEY)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.url = f'https://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def reload_http_pool():
+    # The CA bundle is read when the module is loaded
+    importlib.reload(http_pool)
+
+class PooledHttpTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = StandInGoogleAPI()
+        self.addCleanup(self.standin.close)
+        with mock.patch.dict(os.environ, {'WISECAL_CA_BUNDLE': str(CERT)}):
+            reload_http_pool()
+        self.addCleanup(reload_http_pool)
+
+    def service(self, token='token-1'):
+        http = google_auth_httplib2.AuthorizedHttp(Credentials(token=token), http=http_pool.PooledHttp())
+        return build_from_document(gcal._calendar_discovery(), http=http,
+                                   client_options={'api_endpoint': f'{self.standin.url}/calendar/v3/'})
+
+    def test_calendar_api_over_pooled_transport(self):
+        calendar = self.service().calendars().get(calendarId='cal-1').execute()
+        self.assertEqual(calendar, {'id': 'cal-1', 'authorization': 'Bearer token-1'})
+
+    def test_connections_are_reused_across_users_and_threads(self):
+        errors = []
+        def get_calendars(user):
+            service = self.service(f'token-{user}')
+            try:
+                for i in range(10):
+                    calendar = service.calendars().get(calendarId=f'cal-{i}').execute()
+                    self.assertEqual(calendar['authorization'], f'Bearer token-{user}')
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get_calendars, args=(user,)) for user in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        self.assertLessEqual(self.standin.connections, 4)
+        host = http_pool.stats()['hosts'][self.standin.url]
+        self.assertEqual(host['requests'], 40)
+        self.assertLessEqual(host['connections'], 4)
+        self.assertIn(f'wisecal_http_pool_requests{{host="{self.standin.url}"}} 40.0', metrics.render())
+
+    def test_untrusted_certificate_is_rejected(self):
+        reload_http_pool()
+        with self.assertRaises(ConnectionError):
+            http_pool.PooledHttp().request(f'{self.standin.url}/calendar/v3/calendars/cal-1')
+
+if __name__ == '__main__':
+    unittest.main()
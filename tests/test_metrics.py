@@ -0,0 +1,28 @@
+import unittest
+from unittest import mock
+
+import metrics
+
+class GaugeTest(unittest.TestCase):
+    def test_collected_value_is_cached_for_ttl(self):
+        fn = mock.Mock(side_effect=[3, 5])
+        gauge = metrics.Gauge('wisecal_test_cached_gauge', 'Cached for 30s', fn=fn, ttl=30)
+        self.assertIn('wisecal_test_cached_gauge 3.0', gauge.render())
+        self.assertIn('wisecal_test_cached_gauge 3.0', gauge.render())
+        self.assertEqual(fn.call_count, 1)
+        with mock.patch.object(metrics.time, 'monotonic', return_value=metrics.time.monotonic() + 30):
+            self.assertIn('wisecal_test_cached_gauge 5.0', gauge.render())
+        self.assertEqual(fn.call_count, 2)
+
+    def test_collected_without_ttl_on_every_render(self):
+        fn = mock.Mock(side_effect=[1, 2])
+        gauge = metrics.Gauge('wisecal_test_live_gauge', 'Not cached', fn=fn)
+        self.assertIn('wisecal_test_live_gauge 1.0', gauge.render())
+        self.assertIn('wisecal_test_live_gauge 2.0', gauge.render())
+
+    def test_collected_labelled_values(self):
+        gauge = metrics.Gauge('wisecal_test_labelled_gauge', 'By host', ['host'], fn=lambda: {('b',): 2, ('a',): 1})
+        self.assertIn('wisecal_test_labelled_gauge{host="a"} 1.0\nwisecal_test_labelled_gauge{host="b"} 2.0\n', gauge.render())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import tempfile
+import unittest
+
+import polling
+
+class PollerBudgetTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.poller = polling.Poller(tmp_dir.name, budget=3)
+
+    def test_scheduled_polls_stay_within_budget(self):
+        keys = [('um_feri', str(n)) for n in range(5)]
+        self.assertEqual(len(self.poller.due(keys)), 3)
+        self.assertEqual(self.poller.due(keys), [])
+
+    def test_urgent_polls_do_not_use_budget(self):
+        keys = [('um_feri', str(n)) for n in range(5)]
+        forced = keys[:2]
+        self.poller.trigger(keys[2])
+        selected = self.poller.due(keys, forced)
+        # Three urgent ones first, then the whole budget for the other two
+        self.assertEqual(set(selected[:3]), set(keys[:3]))
+        self.assertEqual(set(selected[3:]), set(keys[3:]))
+        # Scheduled polls only used two of the three
+        self.assertEqual(self.poller.due([('um_feri', '5'), ('um_feri', '6')]), [('um_feri', '5')])
+
+if __name__ == '__main__':
+    unittest.main()
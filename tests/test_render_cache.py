@@ -0,0 +1,96 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import zoneinfo
+
+os.environ['WISECAL_DATA_DIR'] = tempfile.mkdtemp(prefix='wisecal-test-')
+
+import wise_tt
+import wisecal_cron
+
+TZ = zoneinfo.ZoneInfo('Europe/Ljubljana')
+# Hides course, location and lecturer, course B is shifted by three days
+FORMAT = {
+    'DEFAULT': {'PR': {'title': '{ctype_abbr}', 'location': '', 'description': '', 'color': 1}},
+    'B': {'PR': {'start_offset': 3 * 24 * 60, 'end_offset': 3 * 24 * 60}},
+}
+
+def slot(course_abbr, day, hour=10):
+    start = datetime.datetime(2026, 10, day, hour, tzinfo=TZ)
+    return wise_tt.WiseSlot(course=course_abbr, course_abbr=course_abbr, ctype='Predavanje', ctype_abbr='PR',
+                            groups=('RIT 1',), location='G2', lecturer='Dr. X',
+                            start_time=start, end_time=start + datetime.timedelta(hours=2))
+
+class RenderCacheChangesTest(unittest.TestCase):
+    def changes(self, old, new):
+        cache = wisecal_cron.RenderCache(new, wise_tt.diff_slots(old, new))
+        return cache, cache.get_changes(FORMAT)
+
+    def test_removed_event_rendered_by_unchanged_slot_days_apart_is_kept(self):
+        unchanged = slot('B', 5)
+        removed = slot('A', 8)
+        cache, (added, removed_ids) = self.changes([unchanged, removed], [unchanged])
+        # Both render to the same event on the 8th
+        self.assertEqual(wise_tt.FormatPlan(FORMAT).render(unchanged)['id'], wise_tt.FormatPlan(FORMAT).render(removed)['id'])
+        self.assertEqual(added, [])
+        self.assertEqual(removed_ids, frozenset())
+
+    def test_removed_event_is_deleted(self):
+        unchanged = slot('B', 5)
+        removed = slot('A', 9)
+        cache, (added, removed_ids) = self.changes([unchanged, removed], [unchanged])
+        self.assertEqual(removed_ids, {wise_tt.FormatPlan(FORMAT).render(removed)['id']})
+
+    def test_changes_match_full_render(self):
+        old = [slot('A', 8), slot('B', 5), slot('A', 12, 8), slot('B', 6, 12)]
+        new = [slot('B', 5), slot('A', 12, 9), slot('B', 6, 12)]
+        cache, (added, removed_ids) = self.changes(old, new)
+        old_ids = {event['id'] for event in wise_tt.FormatPlan(FORMAT).render_all(old)}
+        new_ids = set(cache.get(FORMAT)[1])
+        self.assertEqual(removed_ids, old_ids - new_ids)
+        self.assertEqual({event['id'] for event in added} - old_ids, new_ids - old_ids)
+
+class RenderCacheConcurrencyTest(unittest.TestCase):
+    def render_concurrently(self, formats, render_all):
+        cache = wisecal_cron.RenderCache([slot('A', 8)])
+        results = [None] * len(formats)
+        def get(i):
+            results[i] = cache.get(formats[i])
+        with mock.patch.object(wise_tt.FormatPlan, 'render_all', render_all):
+            threads = [threading.Thread(target=get, args=(i,)) for i in range(len(formats))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+        return results
+
+    def test_different_fingerprints_render_concurrently(self):
+        # Each render waits for the other one, rendering one at a time would time out
+        barrier = threading.Barrier(2, timeout=5)
+        def render_all(plan, slots):
+            barrier.wait()
+            return []
+        results = self.render_concurrently([{}, FORMAT], render_all)
+        self.assertEqual(results, [([], {}), ([], {})])
+
+    def test_same_fingerprint_renders_once(self):
+        calls = []
+        def render_all(plan, slots):
+            calls.append(plan)
+            return []
+        results = self.render_concurrently([FORMAT] * 4, render_all)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_failed_render_is_retried(self):
+        cache = wisecal_cron.RenderCache([slot('A', 8)])
+        with mock.patch.object(wise_tt.FormatPlan, 'render_all', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                cache.get(FORMAT)
+        self.assertEqual(len(cache.get(FORMAT)[0]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
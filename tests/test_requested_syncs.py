@@ -0,0 +1,98 @@
+import os
+import tempfile
+import time
+import unittest
+import uuid
+from unittest import mock
+
+os.environ['WISECAL_DATA_DIR'] = tempfile.mkdtemp(prefix='wisecal-test-')
+
+import gcal
+import storage
+import wisecal_cron
+import wisecal_worker
+
+class RequestedSyncsTest(unittest.TestCase):
+    def setUp(self):
+        gcal.ensure_dirs()
+        self.owner = f'{uuid.uuid4().hex}@example.com'
+        gcal.save_settings(self.owner, {
+            'calendar': {'enabled': True, 'owner': self.owner, 'title': 'Urnik',
+                         'timetable': {'schoolcode': 'um_feri', 'filterId': '0;1'}},
+            'format': {},
+        })
+        self.worker = wisecal_worker.ShardWorker(shards=1, ttl=60, holder=f'test:{uuid.uuid4().hex}')
+        self.addCleanup(self.worker.stop)
+        self.request()
+
+    def request(self):
+        # Request times must differ to tell a new request from a retried one
+        time.sleep(0.01)
+        gcal.request_sync(self.owner)
+
+    def pending(self):
+        return self.owner in gcal.pending_syncs()
+
+    def sync(self, **kwargs):
+        with mock.patch.object(wisecal_cron, 'sync_user', **kwargs) as sync_user:
+            self.worker.run_requested_syncs({self.owner})
+        return sync_user
+
+    def test_synced_request_is_completed(self):
+        self.worker.rebalance()
+        sync_user = self.sync(return_value=True)
+        sync_user.assert_called_once_with(self.owner)
+        self.assertFalse(self.pending())
+
+    def test_failed_request_stays_pending_with_backoff(self):
+        self.worker.rebalance()
+        self.assertEqual(self.sync(side_effect=RuntimeError('Google is down')).call_count, 1)
+        self.assertTrue(self.pending())
+        # Not retried before the backoff delay
+        self.assertEqual(self.sync(return_value=True).call_count, 0)
+        self.assertTrue(self.pending())
+        with mock.patch.object(wisecal_worker.time, 'monotonic', return_value=time.monotonic() + wisecal_worker.RETRY_MIN_DELAY):
+            self.assertEqual(self.sync(return_value=True).call_count, 1)
+        self.assertFalse(self.pending())
+
+    def test_deferred_request_stays_pending(self):
+        self.worker.rebalance()
+        self.sync(side_effect=wisecal_cron.SyncDeferred('No cached timetable yet'))
+        self.assertTrue(self.pending())
+
+    def test_new_request_is_not_held_back_by_backoff(self):
+        self.worker.rebalance()
+        self.sync(side_effect=RuntimeError('Google is down'))
+        self.request()
+        self.assertEqual(self.sync(return_value=True).call_count, 1)
+        self.assertFalse(self.pending())
+
+    def test_request_without_calendar_to_sync_is_completed(self):
+        self.worker.rebalance()
+        self.sync(return_value=False)
+        self.assertFalse(self.pending())
+
+    def test_request_in_unheld_shard_is_left_pending(self):
+        sync_user = self.sync(return_value=True)
+        sync_user.assert_not_called()
+        self.assertTrue(self.pending())
+
+    def test_requested_sync_takes_shards_first(self):
+        with mock.patch.object(wisecal_cron, 'sync_user', return_value=True) as sync_user:
+            self.assertTrue(self.worker.run_requested_sync(self.owner))
+        sync_user.assert_called_once_with(self.owner)
+        self.assertFalse(self.pending())
+
+class MigrateSyncRequestsTest(unittest.TestCase):
+    def test_pending_syncs_are_migrated(self):
+        for source_backend, target_backend in (('files', 'sqlite'), ('sqlite', 'files')):
+            with self.subTest(source=source_backend), tempfile.TemporaryDirectory() as base_dir:
+                source = storage.open_store(base_dir, source_backend)
+                source.ensure()
+                source.request_sync('ana@example.com', 1700000000.5)
+                target = storage.open_store(base_dir, target_backend)
+                storage.migrate(source, target)
+                self.assertEqual(target.pending_syncs(), {'ana@example.com': 1700000000.5})
+
+if __name__ == '__main__':
+    unittest.main()
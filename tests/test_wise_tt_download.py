@@ -0,0 +1,148 @@
+import http.server
+import json
+import pathlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import wise_tt
+
+ICS = b'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nEND:VCALENDAR\r\n'
+ICS_V2 = b'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nX-WR-CALNAME:v2\r\nEND:VCALENDAR\r\n'
+TIMETABLE = {'schoolcode': 'um_feri', 'filterId': '0;1;2'}
+
+class StandInWiseTT:
+    # Local stand-in for the Wise TT export endpoint. Exports are bound to a
+    # session cookie and answer conditional requests with 304 Not Modified.
+    def __init__(self):
+        self.session = 'session-1'
+        self.etag = '"v1"'
+        self.body = ICS
+        # Answers 304 also to requests that are not conditional
+        self.always_not_modified = False
+        self.requests = []
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                standin.requests.append((self.path, dict(self.headers)))
+                if self.path != '/export.ics':
+                    self.send_error(404)
+                    return
+                if f'JSESSIONID={standin.session}' not in self.headers.get('Cookie', ''):
+                    self.send_error(403)
+                    return
+                if standin.always_not_modified or self.headers.get('If-None-Match') == standin.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/calendar')
+                self.send_header('ETag', standin.etag)
+                self.send_header('Content-Length', str(len(standin.body)))
+                self.end_headers()
+                self.wfile.write(standin.body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeBrowserPool:
+    # Stands in for the browser export: writes the timetable and returns the
+    # export URL with the session cookie the stand-in currently accepts
+    def __init__(self, standin):
+        self.standin = standin
+        self.exports = 0
+
+    def run(self, fn, timetable, download_path):
+        self.exports += 1
+        pathlib.Path(download_path).write_bytes(ICS)
+        return f'{self.standin.url}/export.ics', {'JSESSIONID': self.standin.session}
+
+class DownloadIcalTest(unittest.TestCase):
+    def setUp(self):
+        self.standin = StandInWiseTT()
+        self.addCleanup(self.standin.close)
+        self.pool = FakeBrowserPool(self.standin)
+        patcher = mock.patch.object(wise_tt.browser_pool, 'get_pool', return_value=self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cached = pathlib.Path(tmp_dir.name) / 'um_feri_0;1;2.ics'
+        self.new = pathlib.Path(tmp_dir.name) / 'um_feri_0;1;2.new.ics'
+
+    def download(self):
+        return wise_tt.download_ical(TIMETABLE, self.new, cached_path=self.cached)
+
+    def meta(self):
+        return json.loads(wise_tt._export_meta_path(self.cached).read_text())
+
+    def test_first_download_uses_browser_and_keeps_export_session(self):
+        self.assertEqual(self.download(), self.new)
+        self.assertEqual(self.pool.exports, 1)
+        self.assertEqual(self.meta(), {'url': f'{self.standin.url}/export.ics', 'cookies': {'JSESSIONID': 'session-1'}})
+
+    def test_fast_path_downloads_with_export_cookies(self):
+        self.download()
+        self.new.unlink()
+        self.assertEqual(self.download(), self.new)
+        self.assertEqual(self.pool.exports, 1)
+        self.assertEqual(self.new.read_bytes(), ICS)
+        self.assertEqual(self.meta()['etag'], '"v1"')
+        self.assertIn('JSESSIONID=session-1', self.standin.requests[-1][1]['Cookie'])
+
+    def test_not_modified_returns_cached_copy(self):
+        self.download()
+        self.new.rename(self.cached)
+        self.download()
+        self.new.rename(self.cached)
+        self.assertEqual(self.download(), self.cached)
+        self.assertFalse(self.new.exists())
+        self.assertEqual(self.pool.exports, 1)
+        self.assertEqual(self.standin.requests[-1][1]['If-None-Match'], '"v1"')
+
+    def test_expired_session_falls_back_to_browser(self):
+        self.download()
+        self.new.rename(self.cached)
+        self.standin.session = 'session-2'
+        self.assertEqual(self.download(), self.new)
+        self.assertEqual(self.pool.exports, 2)
+        self.assertEqual(self.meta()['cookies'], {'JSESSIONID': 'session-2'})
+        # The new session is used by the fast path again
+        self.new.unlink()
+        self.assertEqual(self.download(), self.new)
+        self.assertEqual(self.pool.exports, 2)
+
+    def test_discarded_download_is_not_confirmed_by_not_modified(self):
+        self.download()
+        self.new.rename(self.cached)
+        self.download()
+        self.new.rename(self.cached)
+        self.standin.etag = '"v2"'
+        self.standin.body = ICS_V2
+        self.assertEqual(self.download(), self.new)
+        # e.g. the shard was lost before the new version replaced the cached one
+        self.new.unlink()
+        self.assertEqual(self.download(), self.new)
+        self.assertEqual(self.new.read_bytes(), ICS_V2)
+        self.assertNotIn('If-None-Match', self.standin.requests[-1][1])
+
+    def test_not_modified_without_conditional_request_falls_back_to_browser(self):
+        self.download()
+        self.new.unlink()
+        self.standin.always_not_modified = True
+        self.assertEqual(self.download(), self.new)
+        self.assertEqual(self.pool.exports, 2)
+        self.assertTrue(self.new.exists())
+
+if __name__ == '__main__':
+    unittest.main()
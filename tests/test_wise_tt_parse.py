@@ -0,0 +1,62 @@
+import datetime
+import pathlib
+import tempfile
+import unittest
+
+import icalendar
+
+import wise_tt
+
+FIXTURE = pathlib.Path(__file__).parent / 'data' / 'parser.ics'
+
+def baseline_slots(ical_path):
+    # The full icalendar parse iter_slots replaces
+    cal = icalendar.Calendar.from_ical(pathlib.Path(ical_path).read_bytes())
+    return [wise_tt._slot_from_event(component) for component in cal.walk() if component.name == "VEVENT"]
+
+def offsets(slot):
+    return tuple(t.utcoffset() if isinstance(t, datetime.datetime) else None
+                 for t in (slot.start_time, slot.end_time))
+
+class IterSlotsTest(unittest.TestCase):
+    def test_matches_full_parse(self):
+        slots = list(wise_tt.iter_slots(FIXTURE))
+        self.assertEqual(len(slots), 4)
+        self.assertEqual(slots, baseline_slots(FIXTURE))
+        # Aware datetimes compare by instant, so also check the zones resolved the same
+        self.assertEqual([offsets(slot) for slot in slots], [offsets(slot) for slot in baseline_slots(FIXTURE)])
+
+    def test_malformed_line_is_skipped(self):
+        slot = list(wise_tt.iter_slots(FIXTURE))[3]
+        self.assertEqual(slot.course, 'Fizika')
+        self.assertEqual(slot.groups, ('RIT UN 1',))
+        self.assertEqual(slot.location, 'G2-P02')
+
+    def test_fold_inside_multibyte_character(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ical_path = pathlib.Path(tmp) / 'timetable.ics'
+            ical_path.write_bytes(FIXTURE.read_bytes().replace(
+                b'SUMMARY:Ra\xc4\x8d\r\n unalni', b'SUMMARY:Ra\xc4\r\n \x8dunalni'))
+            slot = next(wise_tt.iter_slots(ical_path))
+        self.assertEqual(slot.course, 'Računalniške komunikacije')
+        self.assertEqual(slot.lecturer, 'Dr. Ana Novak')
+
+class ContentDigestTest(unittest.TestCase):
+    def digest(self, ics):
+        with tempfile.TemporaryDirectory() as tmp:
+            ical_path = pathlib.Path(tmp) / 'timetable.ics'
+            ical_path.write_bytes(ics)
+            return wise_tt.compute_content_digest(ical_path)
+
+    def test_ignores_volatile_properties(self):
+        ics = FIXTURE.read_bytes()
+        self.assertEqual(self.digest(ics), self.digest(ics.replace(b'DTSTAMP:20251001T120000Z', b'DTSTAMP:20251002T120000Z')))
+        self.assertNotEqual(self.digest(ics), self.digest(ics.replace(b'LOCATION:G3-Ka', b'LOCATION:G3-Kb')))
+
+    def test_line_without_property_name(self):
+        ics = FIXTURE.read_bytes()
+        changed = ics.replace(b'ob torkih v drugem tednu', b'(ob torkih v drugem tednu)')
+        self.assertNotEqual(self.digest(ics), self.digest(changed))
+
+if __name__ == '__main__':
+    unittest.main()
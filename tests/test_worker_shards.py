@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import storage
+
+SHARDS = 4
+TIMETABLES = [('um_feri', str(n)) for n in range(12)]
+LEASE_TTL = 1.0  # seconds
+STALL = 3 * LEASE_TTL  # seconds
+
+def _log(log_path):
+    conn = sqlite3.connect(log_path, timeout=30, isolation_level=None)
+    conn.execute('CREATE TABLE IF NOT EXISTS processed (schoolcode TEXT, filter_id TEXT, holder TEXT)')
+    return conn
+
+def _processed(log_path):
+    conn = _log(log_path)
+    try:
+        return conn.execute('SELECT schoolcode, filter_id, holder FROM processed').fetchall()
+    finally:
+        conn.close()
+
+def _run_worker(data_dir, log_path, stall, started, passed, stop):
+    # A sync runner in its own process. Downloads and syncs are replaced by a
+    # log of processed timetables, every logged timetable counts as synced.
+    # The stalled runner stops renewing its leases and takes longer than the
+    # lease TTL to download, like a process paused in the middle of a pass.
+    os.environ['WISECAL_DATA_DIR'] = data_dir
+    import wisecal_cron
+    import wisecal_worker
+
+    local = threading.local()
+    def log():
+        if not hasattr(local, 'conn'):
+            local.conn = _log(log_path)
+        return local.conn
+    def due(keys, forced=()):
+        done = {(schoolcode, filterId) for schoolcode, filterId, _ in log().execute('SELECT * FROM processed')}
+        return [key for key in keys if key not in done]
+    def download_timetable(schoolcode, filterId, school_limit, fence=None):
+        if stall:
+            started.set()
+            time.sleep(STALL)
+        return pathlib.Path(data_dir) / 'calendars' / f'{schoolcode}_{filterId}.new.ics'
+    def process_timetable(schoolcode, filterId, users, new_tt):
+        log().execute('INSERT INTO processed VALUES (?, ?, ?)', (schoolcode, filterId, worker.holder))
+        wisecal_cron._timetable_path(schoolcode, filterId).write_text('BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n')
+        time.sleep(0.05)
+        return False
+
+    wisecal_worker.TICK = 0.1
+    wisecal_cron.poller.due = due
+    wisecal_cron.poller.record = lambda key, digest=None, failed=False: None
+    wisecal_cron.download_timetable = download_timetable
+    wisecal_cron.process_timetable = process_timetable
+    worker = wisecal_worker.ShardWorker(shards=SHARDS, ttl=LEASE_TTL)
+    if stall:
+        worker._renew_loop = lambda: None
+    worker.start()
+    try:
+        if stall:
+            worker.run_pass()
+            passed.set()
+            stop.wait()
+        else:
+            thread = threading.Thread(target=worker.run_forever, args=(0.2,))
+            thread.start()
+            stop.wait()
+            worker._stopped.set()
+            thread.join()
+    finally:
+        worker.stop()
+
+class ShardWorkerProcessesTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data_dir = tmp_dir.name
+        self.log_path = str(pathlib.Path(self.data_dir) / 'processed.sqlite3')
+        _log(self.log_path).close()
+        store = storage.FileStore(self.data_dir)
+        store.ensure()
+        for n, (schoolcode, filterId) in enumerate(TIMETABLES):
+            store.save_settings(f'user{n}@example.com', {
+                'calendar': {'enabled': True, 'owner': f'user{n}@example.com', 'title': 'Urnik',
+                             'timetable': {'schoolcode': schoolcode, 'filterId': filterId}},
+                'format': {},
+            })
+        self.ctx = multiprocessing.get_context('spawn')
+        self.stop = self.ctx.Event()
+        self.processes = []
+        self.addCleanup(self.stop_workers)
+
+    def start_worker(self, stall=False):
+        started, passed = self.ctx.Event(), self.ctx.Event()
+        process = self.ctx.Process(target=_run_worker, args=(self.data_dir, self.log_path, stall, started, passed, self.stop))
+        process.start()
+        # The events must outlive the child's start-up, it unpickles them
+        self.processes.append((process, started, passed))
+        return started, passed
+
+    def stop_workers(self):
+        self.stop.set()
+        for process, _, _ in self.processes:
+            process.join(30)
+            if process.is_alive():
+                process.kill()
+
+    def test_timetables_of_a_lost_shard_are_synced_once(self):
+        # The stalled runner takes every shard, then loses them while its pass
+        # is still running. Two other runners take over and sync everything.
+        started, passed = self.start_worker(stall=True)
+        self.assertTrue(started.wait(60))
+        self.start_worker()
+        self.start_worker()
+        deadline = time.monotonic() + 60
+        while len(_processed(self.log_path)) < len(TIMETABLES) and time.monotonic() < deadline:
+            time.sleep(0.2)
+        # The stalled pass resumes after its leases were taken over
+        self.assertTrue(passed.wait(60))
+        time.sleep(1)
+        self.stop_workers()
+        for process, _, _ in self.processes:
+            self.assertEqual(process.exitcode, 0)
+
+        processed = _processed(self.log_path)
+        counts = {key: 0 for key in TIMETABLES}
+        for schoolcode, filterId, holder in processed:
+            counts[(schoolcode, filterId)] += 1
+        self.assertEqual(counts, {key: 1 for key in TIMETABLES})
+
+if __name__ == '__main__':
+    unittest.main()
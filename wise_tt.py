@@ -1,228 +1,718 @@
-from playwright.sync_api import sync_playwright
+import browser_pool
 import icalendar
+import http_pool
+import metrics
 import hashlib
 import datetime
 import base64
+import logging
+import pathlib
+import json
+import os
+import collections
+import threading
+import pickle
+import sys
+import functools
+import re
+
+logger = logging.getLogger(__name__)
+
+WTT_API_URL = os.getenv('WISECAL_WTT_URL', "https://www.wise-tt.com")
+
+_download_seconds = metrics.Histogram('wisecal_ical_download_seconds', 'Timetable downloads by path (http fast path or browser)', ['path'])
+_download_failures = metrics.Counter('wisecal_ical_download_failures_total', 'Failed timetable downloads by path', ['path'])
+_download_not_modified = metrics.Counter('wisecal_ical_not_modified_total', 'Timetable downloads answered with 304 Not Modified')
+_parse_seconds = metrics.Histogram('wisecal_ical_parse_seconds', 'Parsing a timetable into slots, slot cache misses only')
+_parsed_slots = metrics.Histogram('wisecal_ical_slots', 'Slots per parsed timetable',
+                                buckets=(10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000))
+_render_seconds = metrics.Histogram('wisecal_render_seconds', 'Rendering slots into Google Calendar events')
+
+def _export_ical(context, timetable, download_path):
+    page = context.new_page()
+    url = f"{WTT_API_URL}/wtt_{timetable['schoolcode']}/index.jsp?filterId={timetable['filterId']}"
+    response = page.goto(url, timeout=5000)
+    if not response or not response.ok:
+        raise ValueError(f"Napaka pri nalaganju {url}, status: {response.status if response else 'no response'}")
+    if page.locator('a[title="Izvoz celotnega urnika v ICS formatu  "]').count() == 0:
+        raise ValueError(f"Urnik na {url} nima aktivnih terminov.")
+    # print(f"Navigated to {url}")
+    with page.expect_download(timeout=5000) as download_info:
+        # print("Clicked on iCal export link")
+        page.click('a[title="Izvoz celotnega urnika v ICS formatu  "]', timeout=3000)
+        # print("Waiting for download to start...")
+    download = download_info.value
+    download.save_as(download_path)
+    # print(f"Downloaded iCal file to {download_path}")
+    # The URL behind the export link and the context's cookies for it, reused by
+    # the fast path on the next download since the URL may be bound to the session
+    cookies = {cookie['name']: cookie['value'] for cookie in context.cookies([download.url])} if download.url else {}
+    return download.url, cookies
+
+def _export_meta_path(ical_path):
+    return pathlib.Path(ical_path).with_suffix('.export.json')
 
-WTT_API_URL = "https://www.wise-tt.com"
-
-def download_ical(timetable, download_path):
-    with sync_playwright() as p:
-        # print("Launching browser...")
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        url = f"{WTT_API_URL}/wtt_{timetable['schoolcode']}/index.jsp?filterId={timetable['filterId']}"
-        response = page.goto(url, timeout=5000)
-        if not response or not response.ok:
-            raise ValueError(f"Napaka pri nalaganju {url}, status: {response.status if response else 'no response'}")
-        if page.locator('a[title="Izvoz celotnega urnika v ICS formatu  "]').count() == 0:
-            raise ValueError(f"Urnik na {url} nima aktivnih terminov.")
-        # print(f"Navigated to {url}")
-        with page.expect_download(timeout=5000) as download_info:
-            # print("Clicked on iCal export link")
-            page.click('a[title="Izvoz celotnega urnika v ICS formatu  "]', timeout=3000)
-            # print("Waiting for download to start...")
-        download = download_info.value
-        download.save_as(download_path)
-        # print(f"Downloaded iCal file to {download_path}")
-        browser.close()
-    return download_path        
+def _load_export_meta(meta_path):
+    try:
+        with open(meta_path, 'r') as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_export_meta(meta_path, meta):
+    with open(meta_path, 'w') as fh:
+        json.dump(meta, fh)
+
+def _fetch_ical(meta, download_path, cached_path):
+    headers = {}
+    # The validators describe the file with the stored digest. A download that
+    # never became the cached copy (discarded, or lost in a crash) must not be
+    # confirmed by a 304, so the cached copy is then downloaded in full.
+    if cached_path is not None and pathlib.Path(cached_path).exists() and meta.get('digest') == file_digest(cached_path):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    conditional = bool(headers)
+    if meta.get('cookies'):
+        # Sent explicitly, the shared session never stores cookies
+        headers['Cookie'] = '; '.join(f"{name}={value}" for name, value in meta['cookies'].items())
+    response = http_pool.session.get(meta['url'], headers=headers, timeout=10)
+    if response.status_code == 304:
+        if not conditional:
+            raise ValueError(f"Odgovor 304 z {meta['url']} brez pogojne zahteve.")
+        return cached_path
+    response.raise_for_status()
+    if not response.content.lstrip().startswith(b'BEGIN:VCALENDAR'):
+        raise ValueError(f"Odgovor z {meta['url']} ni v ICS formatu.")
+    with open(download_path, 'wb') as fh:
+        fh.write(response.content)
+    meta['etag'] = response.headers.get('ETag')
+    meta['last_modified'] = response.headers.get('Last-Modified')
+    meta['digest'] = hashlib.sha256(response.content).hexdigest()
+    return download_path
+
+def download_ical(timetable, download_path, cached_path=None):
+    # Returns the path of the current timetable: download_path, or cached_path
+    # when the server reports that the cached copy is still up to date.
+    meta_path = _export_meta_path(cached_path or download_path)
+    meta = _load_export_meta(meta_path)
+    if meta.get('url'):
+        try:
+            with _download_seconds.time(path='http'):
+                result = _fetch_ical(meta, download_path, cached_path)
+            if result == cached_path:
+                _download_not_modified.inc()
+            _save_export_meta(meta_path, meta)
+            return result
+        except Exception as e:
+            _download_failures.inc(path='http')
+            logger.info(f"Fast ICS export failed for {timetable['schoolcode']}, {timetable['filterId']}, falling back to browser: {e}")
+            meta_path.unlink(missing_ok=True)
+
+    # Browsers are long-lived and shared, each export gets its own isolated context
+    try:
+        with _download_seconds.time(path='browser'):
+            export_url, cookies = browser_pool.get_pool().run(_export_ical, timetable, download_path)
+    except Exception:
+        _download_failures.inc(path='browser')
+        raise
+    if export_url and export_url.startswith(('http://', 'https://')):
+        _save_export_meta(meta_path, {'url': export_url, 'cookies': cookies})
+    return download_path
 
 class WiseSlot:
-    course = "" # Course name - e.g., "Spletne tehnologije"
-    course_abbr = ""  # Course abbreviation - e.g., "ST"
-    ctype = ""  # Course type - e.g., "Predavanje", "Računalniške vaje", "Seminarska vaje"
-    ctype_abbr = ""  # Course type abbreviation - e.g., "PR", "RV", "SV"
-    groups = []  # List of groups for this course type - e.g., "MAG 1 RIT", "MAG 1 RIT RV 5"
-    location = ""  # Location of the session
-    lecturer = ""  # Lecturer's name
-    start_time = None  # Start time as datetime object
-    end_time = None    # End time as datetime object
-
-    _hash = None # Cached hash value
-
-    def _fmt_self(self, fmt):
-        return fmt.format(
-            course=self.course,
-            course_abbr=self.course_abbr,
-            ctype=self.ctype,
-            ctype_abbr=self.ctype_abbr,
-            groups=", ".join(self.groups),
-            location=self.location,
-            lecturer=self.lecturer,
-            start_time=self.start_time,
-            end_time=self.end_time
-        )
-    
+    # Large timetables produce tens of thousands of slots that repeat the same
+    # few strings, so slots have no __dict__ and their strings are interned.
+    __slots__ = ('course', 'course_abbr', 'ctype', 'ctype_abbr', 'groups', 'location', 'lecturer', 'start_time', 'end_time')
+
+    def __init__(self, course="", course_abbr="", ctype="", ctype_abbr="", groups=(), location="", lecturer="", start_time=None, end_time=None):
+        self.course = sys.intern(course)  # Course name - e.g., "Spletne tehnologije"
+        self.course_abbr = sys.intern(course_abbr)  # Course abbreviation - e.g., "ST"
+        self.ctype = sys.intern(ctype)  # Course type - e.g., "Predavanje", "Računalniške vaje", "Seminarska vaje"
+        self.ctype_abbr = sys.intern(ctype_abbr)  # Course type abbreviation - e.g., "PR", "RV", "SV"
+        self.groups = tuple(sys.intern(g) for g in groups)  # Groups for this course type - e.g., "MAG 1 RIT", "MAG 1 RIT RV 5"
+        self.location = sys.intern(location)  # Location of the session
+        self.lecturer = sys.intern(lecturer)  # Lecturer's name
+        self.start_time = start_time  # Start time as datetime object
+        self.end_time = end_time    # End time as datetime object
+
+    def _format_fields(self):
+        return {
+            'course': self.course,
+            'course_abbr': self.course_abbr,
+            'ctype': self.ctype,
+            'ctype_abbr': self.ctype_abbr,
+            'groups': ", ".join(self.groups),
+            'location': self.location,
+            'lecturer': self.lecturer,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+        }
+
+    def fingerprint(self):
+        # Everything a slot renders from, stable across parses of the same event
+        return (self.course, self.course_abbr, self.ctype, self.ctype_abbr, self.groups,
+                self.location, self.lecturer, self.start_time, self.end_time)
+
+    def __eq__(self, other):
+        if not isinstance(other, WiseSlot):
+            return NotImplemented
+        return self.fingerprint() == other.fingerprint()
+
+    def __hash__(self):
+        return hash(self.fingerprint())
+
+    def stable_id(self):
+        # Google event ID from what identifies the session in the timetable, so
+        # room, lecturer or format changes update the event instead of replacing it
+        start = self.start_time.isoformat() if self.start_time is not None else ''
+        identity = f"{self.course}|{self.ctype_abbr}|{','.join(self.groups)}|{start}"
+        return _event_id(identity)
+
     def to_gcal(self, f):
-        fsel = 'PR' if self.ctype_abbr == 'PR' else 'VAJE'
-        df = f.get('DEFAULT', {}).get(fsel, {})
-        cf = f.get(self.course_abbr, {}).get(fsel, {})
-        def v(key, default):
-            return cf.get(key, df.get(key, default))
-        color = v('color', None)
-        if color is None:
-            b0 = hashlib.md5(self.course_abbr.encode('utf-8')).digest()[0]
-            color = (b0 % 11) + 1  # Google Calendar colors are 1-11
-        title_fmt = v('title', "{course} {ctype_abbr}")
-        location_fmt = v('location', "{location}")
-        description_fmt = v('description', "{course} {ctype} by {lecturer} for groups: {groups}")
-        start_offset = v('start_offset', None)
-        end_offset = v('end_offset', None)
-        exclude_groups = df.get('exclude_groups', []) + cf.get('exclude_groups', [])
-        filtered_groups = [g for g in self.groups if g not in exclude_groups]
-        if len(filtered_groups) == 0:
+        return FormatPlan(f).render(self)
+
+@functools.lru_cache(maxsize=4096)
+def _default_color(course_abbr):
+    b0 = hashlib.md5(course_abbr.encode('utf-8')).digest()[0]
+    return (b0 % 11) + 1  # Google Calendar colors are 1-11
+
+def _event_id(hash_input):
+    # Google event IDs may only use base32hex characters
+    md5_input = hashlib.md5(hash_input.encode('utf-8')).digest()
+    return base64.b32hexencode(md5_input).decode('utf-8').rstrip('=').lower()
+
+def event_content_hash(event):
+    # Hash of everything a rendered event shows, also its ID unless stable IDs are used
+    return _event_id(f"{event['summary']}|{event['location']}|{event['description']}|{event['start']['dateTime']}|{event['end']['dateTime']}|{event['colorId']}")
+
+_FormatRule = collections.namedtuple('_FormatRule', ['title', 'location', 'description', 'color', 'start_offset', 'end_offset', 'exclude_groups'])
+
+class FormatPlan:
+    # settings['format'] resolved once per (course_abbr, PR/VAJE), so rendering
+    # a slot list does no dict merging or colour hashing per slot
+    def __init__(self, f, stable_ids=False):
+        self.format = f
+        self.stable_ids = stable_ids
+        self._rules = {}
+
+    def rule(self, course_abbr, fsel):
+        rule = self._rules.get((course_abbr, fsel))
+        if rule is None:
+            df = self.format.get('DEFAULT', {}).get(fsel, {})
+            cf = self.format.get(course_abbr, {}).get(fsel, {})
+            def v(key, default):
+                return cf.get(key, df.get(key, default))
+            color = v('color', None)
+            if color is None:
+                color = _default_color(course_abbr)
+            start_offset = v('start_offset', None)
+            end_offset = v('end_offset', None)
+            rule = _FormatRule(
+                title=v('title', "{course} {ctype_abbr}"),
+                location=v('location', "{location}"),
+                description=v('description', "{course} {ctype} by {lecturer} for groups: {groups}"),
+                color=color,
+                start_offset=datetime.timedelta(minutes=start_offset) if start_offset is not None else None,
+                end_offset=datetime.timedelta(minutes=end_offset) if end_offset is not None else None,
+                exclude_groups=frozenset(df.get('exclude_groups', []) + cf.get('exclude_groups', [])),
+            )
+            self._rules[(course_abbr, fsel)] = rule
+        return rule
+
+    def start_time(self, slot):
+        # Start of the event rendered from slot, with the rule's offset applied
+        rule = self.rule(slot.course_abbr, 'PR' if slot.ctype_abbr == 'PR' else 'VAJE')
+        return slot.start_time + rule.start_offset if rule.start_offset is not None else slot.start_time
+
+    def render(self, slot):
+        rule = self.rule(slot.course_abbr, 'PR' if slot.ctype_abbr == 'PR' else 'VAJE')
+        if not any(g not in rule.exclude_groups for g in slot.groups):
             return None
-        title = self._fmt_self(title_fmt)
-        location = self._fmt_self(location_fmt)
-        description = self._fmt_self(description_fmt)
-        start_time = self.start_time
-        end_time = self.end_time
-        if start_offset is not None:
-            start_time += datetime.timedelta(minutes=start_offset)
-        if end_offset is not None:
-            end_time += datetime.timedelta(minutes=end_offset)
-
-        hash_input = f"{title}|{location}|{description}|{start_time.isoformat()}|{end_time.isoformat()}|{color}"
-        md5_input = hashlib.md5(hash_input.encode('utf-8')).digest()
-        
+        fields = slot._format_fields()
+        title = rule.title.format(**fields)
+        location = rule.location.format(**fields)
+        description = rule.description.format(**fields)
+        start_time = slot.start_time
+        end_time = slot.end_time
+        if rule.start_offset is not None:
+            start_time += rule.start_offset
+        if rule.end_offset is not None:
+            end_time += rule.end_offset
+        start_iso = start_time.isoformat()
+        end_iso = end_time.isoformat()
+
+        if self.stable_ids:
+            event_id = slot.stable_id()
+        else:
+            event_id = _event_id(f"{title}|{location}|{description}|{start_iso}|{end_iso}|{rule.color}")
+
         return {
-            'id': base64.b32hexencode(md5_input).decode('utf-8').rstrip('=').lower(),
+            'id': event_id,
             'summary': title,
             'location': location,
             'description': description,
             'start': {
-                'dateTime': start_time.isoformat(),
+                'dateTime': start_iso,
                 'timeZone': 'Europe/Ljubljana',
             },
             'end': {
-                'dateTime': end_time.isoformat(),
+                'dateTime': end_iso,
                 'timeZone': 'Europe/Ljubljana',
             },
-            'colorId': color,
+            'colorId': rule.color,
         }
 
+    def render_all(self, slots):
+        with _render_seconds.time():
+            events = []
+            rendered_slots = []
+            for slot in slots:
+                event = self.render(slot)
+                if event is not None:
+                    events.append(event)
+                    rendered_slots.append(slot)
+            if self.stable_ids:
+                _disambiguate_ids(events, rendered_slots)
+        return events
+
+def _disambiguate_ids(events, slots):
+    # Sessions with the same course, type, groups and start (e.g. a group split
+    # over two rooms) get numbered IDs, ordered by the rest of the slot
+    by_id = {}
+    for i, event in enumerate(events):
+        by_id.setdefault(event['id'], []).append(i)
+    for event_id, indices in by_id.items():
+        if len(indices) < 2:
+            continue
+        indices.sort(key=lambda i: (slots[i].location, slots[i].lecturer, str(slots[i].end_time), slots[i].course_abbr, slots[i].ctype))
+        for n, i in enumerate(indices[1:], 1):
+            events[i]['id'] = f"{event_id}{n}"
+
+def _prune_empty(value):
+    if isinstance(value, dict):
+        pruned = {k: _prune_empty(v) for k, v in value.items()}
+        return {k: v for k, v in pruned.items() if v not in ({}, [], None)}
+    return value
+
+def format_fingerprint(f):
+    # Equal fingerprints render identical events, empty sections do not count
+    canonical = json.dumps(_prune_empty(f or {}), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class SlotCache:
+    # Parsed slot lists keyed by ICS content hash: a small in-memory LRU
+    # in front of pickles on disk that survive process restarts.
+    def __init__(self, cache_dir, size: int, disk_size: int):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.size = size
+        self.disk_size = disk_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key):
+        return self.cache_dir / f'{key}.pickle'
+
+    def get(self, key):
+        with self._lock:
+            slots = self._entries.get(key)
+            if slots is not None:
+                self._entries.move_to_end(key)
+                return slots
+        try:
+            with open(self._disk_path(key), 'rb') as fh:
+                slots = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Discarding unreadable slot cache entry {key}: {e}")
+            self._disk_path(key).unlink(missing_ok=True)
+            return None
+        self._remember(key, slots)
+        return slots
+
+    def put(self, key, slots):
+        self._remember(key, slots)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._disk_path(key).with_suffix(f'.{threading.get_ident()}.tmp')
+            with open(tmp_path, 'wb') as fh:
+                pickle.dump(slots, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._disk_path(key))
+            self._prune_disk()
+        except OSError as e:
+            logger.warning(f"Failed to write slot cache entry {key}: {e}")
+
+    def _remember(self, key, slots):
+        with self._lock:
+            self._entries[key] = slots
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        entries = sorted(self.cache_dir.glob('*.pickle'), key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in entries[self.disk_size:]:
+            path.unlink(missing_ok=True)
+
+# Bump whenever parsing or the WiseSlot layout changes so stale cache entries are ignored
+_SLOT_CACHE_VERSION = 3
+_slot_cache = SlotCache(
+    pathlib.Path(os.getenv('WISECAL_DATA_DIR', './wc_data')) / 'slot_cache',
+    size=int(os.getenv('WISECAL_SLOT_CACHE_SIZE', '32')),
+    disk_size=int(os.getenv('WISECAL_SLOT_CACHE_DISK_SIZE', '512')),
+)
+
+def file_digest(ical_path):
+    with open(ical_path, 'rb') as fh:
+        return hashlib.file_digest(fh, 'sha256').hexdigest()
+
+# Properties Wise TT regenerates on every export, they do not describe the timetable
+_VOLATILE_PROPERTIES = frozenset(['DTSTAMP', 'LAST-MODIFIED', 'CREATED', 'SEQUENCE', 'UID'])
+_PROPERTY_NAME = re.compile(r'[A-Za-z0-9-]+')
+
+def _is_volatile(line):
+    # Lines without a property name are kept, they are content icalendar would skip
+    name = _PROPERTY_NAME.match(line)
+    return name is not None and name[0].upper() in _VOLATILE_PROPERTIES
+
+def _content_digest_path(ical_path):
+    return pathlib.Path(ical_path).with_suffix('.sha256')
+
+def compute_content_digest(ical_path):
+    # Hashes every VEVENT without its volatile properties, then combines the
+    # sorted event hashes so neither property nor event order matters
+    event_digests = []
+    for lines in _iter_vevents(ical_path):
+        lines = sorted(line for line in lines if not _is_volatile(line))
+        event_digests.append(hashlib.sha256("\n".join(lines).encode()).digest())
+    event_digests.sort()
+    return hashlib.sha256(b''.join(event_digests)).hexdigest()
+
+def content_digest(ical_path):
+    # The normalized digest is stored next to the ICS and reused while it is newer than the file
+    digest_path = _content_digest_path(ical_path)
+    try:
+        if digest_path.stat().st_mtime_ns >= pathlib.Path(ical_path).stat().st_mtime_ns:
+            with open(digest_path, 'r') as fh:
+                digest = fh.read().strip()
+            if digest:
+                return digest
+    except FileNotFoundError:
+        pass
+    digest = compute_content_digest(ical_path)
+    with open(digest_path, 'w') as fh:
+        fh.write(digest)
+    return digest
+
+def rename_ical(ical_path, target_path):
+    # Moves an ICS together with its stored content digest and catalog
+    pathlib.Path(ical_path).rename(target_path)
+    for sidecar_path in (_content_digest_path, _catalog_path):
+        if sidecar_path(ical_path).exists():
+            sidecar_path(ical_path).rename(sidecar_path(target_path))
+        else:
+            sidecar_path(target_path).unlink(missing_ok=True)
+
+def remove_ical(ical_path):
+    pathlib.Path(ical_path).unlink(missing_ok=True)
+    _content_digest_path(ical_path).unlink(missing_ok=True)
+    _catalog_path(ical_path).unlink(missing_ok=True)
+
 def get_slots(ical_path):
-    cal = icalendar.Calendar.from_ical(open(ical_path, 'rb').read())
-    events = []
-
-    def fallback_event(component):
-        slot = WiseSlot()
-        slot.course = str(component.get('SUMMARY')).capitalize() + " (Fallback)"
-        slot.location = str(component.get('LOCATION'))
-        slot.start_time = component.get('DTSTART').dt
-        slot.end_time = component.get('DTEND').dt
-        slot.ctype = "Unknown"
-        slot.ctype_abbr = "UN"
-        slot.lecturer = "Unknown"
-        slot.groups = []
-        return slot
-
-    for component in cal.walk():
-        if component.name == "VEVENT":
-            slot = WiseSlot()
-            slot.course = str(component.get('SUMMARY')).capitalize()
-            dparts = str(component.get('DESCRIPTION')).split(", ")
-            if len(dparts) < 4:
-                print(f"Warning: DESCRIPTION field does not have enough parts: '{component.get('DESCRIPTION')}'")
-                events.append(fallback_event(component))
-                continue
-            if slot.course != dparts[0].capitalize():
-                print(f"Warning: SUMMARY and DESCRIPTION course names do not match: '{slot.course}' != '{dparts[0].capitalize()}'")
-                events.append(fallback_event(component))
-                continue
-            abbr_ignore = ['in']
-            slot.course_abbr = "".join([word[0] for word in slot.course.split(" ") if word and word.lower() not in abbr_ignore]).upper()
-            slot.ctype_abbr = dparts[1]
-            ctype_map = {
-                'PR': 'Predavanje',
-                'SV': 'Seminarske vaje',
-                'LV': 'Laboratorijske vaje',
-                'SE': 'Seminar',
-                'RV': 'Računalniške vaje'
-            }
-            slot.ctype = ctype_map.get(slot.ctype_abbr, slot.ctype_abbr)
-            slot.location = str(component.get('LOCATION'))
-
-            lecturers = []
-            groups = []
-            groups_started = False
-            lecutrers_and_groups = dparts[2:]
-
-            # We need to heuristically separate lecturers and groups from the remaining parts
-            # Assumptions:
-            # - The first part is always a lecturer
-            # - The last part is always a group
-            # - After the first part, once we start seeing groups, all subsequent parts are groups
-            # - Groups often contain digits or specific keywords
-            for i, part in enumerate(lecutrers_and_groups):
-                # First part is always lecturer
-                if i == 0:
-                    lecturers.append(part.title())
-                    # print(f"First part, adding lecturer: {part.title()}")
-                    continue
-                # Last part is always group or groups started
-                if i == len(lecutrers_and_groups) - 1 or groups_started:
-                    groups.append(part)
-                    # print(f"Adding group: {part}")
-                    continue
-
-                # Now decide based on content
-                units = part.replace('.', '').lower().split(' ')
-                # If we find a digit, we assume it's a group
-                if any(char.isdigit() for char in part):
-                    groups_started = True
-                    groups.append(part)
-                    # print(f"Found digit, adding group: {part}")
-                    continue
-
-                # Check for common lecturer indicators
-                lecturer_indicators = ['dr', 'prof', 'doc', 'asist', 'demonstrator']
-                if any(unit == indicator for unit in units for indicator in lecturer_indicators):
-                    lecturers.append(part.title())
-                    # print(f"Found lecturer indicator, adding lecturer: {part.title()}")
-                    continue
-
-                # Check for common group indicators
-                group_indicators = ['sk', 'erasmus', 'rv', 'vs', 'un', 'mag', 'izb']
-                if any(unit == indicator for unit in units for indicator in group_indicators):
-                    groups_started = True
-                    groups.append(part)
-                    # print(f"Found group indicator, adding group: {part}")
-                    continue
-
-                # If there's only one word, assume it's a group
-                if len(units) == 1:
-                    groups_started = True
-                    groups.append(part)
-                    # print(f"Single unit, assuming group, adding: {part}")
-                    continue
-
-                # Default to lecturer if none of the above matched
-                lecturers.append(part.title())
-                # print(f"Defaulting to lecturer, adding: {part.title()}")
-
-            slot.lecturer = ", ".join(lecturers)
-            slot.groups = [group.strip() for group in groups]
-
-            slot.start_time = component.get('DTSTART').dt
-            slot.end_time = component.get('DTEND').dt
-            events.append(slot)
-    return events
+    key = f"v{_SLOT_CACHE_VERSION}-{file_digest(ical_path)}"
+    slots = _slot_cache.get(key)
+    if slots is None:
+        with _parse_seconds.time():
+            slots = list(iter_slots(ical_path))
+        _parsed_slots.observe(len(slots))
+        _slot_cache.put(key, slots)
+        logger.debug(f"Parsed {len(slots)} slots from {ical_path}, classifier: {classifier_stats()}")
+    # Callers get their own list, the slots themselves are shared
+    return list(slots)
 
-def get_session_filters(slots):
+# Bump whenever the catalog layout changes so stale catalogs are rebuilt
+_CATALOG_VERSION = 1
+
+def _catalog_path(ical_path):
+    return pathlib.Path(ical_path).with_suffix('.catalog.json')
+
+def build_catalog(slots):
+    # Courses with their abbreviations, types and groups, and the session
+    # filters of a timetable, collected in a single pass over its slots
+    names = set()
+    by_abbr = {}
+    pr_groups = set()
+    rv_groups = set()
     filters = set()
     for slot in slots:
+        names.add((slot.course, slot.course_abbr))
+        course = by_abbr.get(slot.course_abbr)
+        if course is None:
+            course = by_abbr[slot.course_abbr] = {'types': {}, 'pr_groups': set(), 'rv_groups': set()}
+        course['types'][slot.ctype_abbr] = slot.ctype
+        if slot.ctype_abbr == 'PR':
+            course['pr_groups'].update(slot.groups)
+            pr_groups.update(slot.groups)
+        else:
+            course['rv_groups'].update(slot.groups)
+            rv_groups.update(slot.groups)
         for group in slot.groups:
             filters.add((slot.course, slot.ctype, group))
-    return sorted(list(filters), key=lambda x: (x[0], x[1], x[2]))
+    return {
+        'version': _CATALOG_VERSION,
+        'slots': len(slots),
+        'pr_groups': sorted(pr_groups),
+        'rv_groups': sorted(rv_groups),
+        'courses': [{
+            'name': name,
+            'id': abbr,
+            'types': dict(sorted(by_abbr[abbr]['types'].items())),
+            'pr_groups': sorted(by_abbr[abbr]['pr_groups']),
+            'rv_groups': sorted(by_abbr[abbr]['rv_groups']),
+        } for name, abbr in sorted(names)],
+        'filters': [list(f) for f in sorted(filters)],
+    }
+
+def get_catalog(ical_path, slots=None):
+    # The catalog is stored next to the ICS under the timetable's content
+    # digest and rebuilt from slots (parsed when not given) once it changes
+    digest = content_digest(ical_path)
+    catalog_path = _catalog_path(ical_path)
+    try:
+        with open(catalog_path, 'r', encoding='utf-8') as fh:
+            catalog = json.load(fh)
+        if catalog.get('version') == _CATALOG_VERSION and catalog.get('digest') == digest:
+            return catalog
+    except (FileNotFoundError, ValueError):
+        pass
+    catalog = build_catalog(slots if slots is not None else get_slots(ical_path))
+    catalog['digest'] = digest
+    tmp_path = catalog_path.with_suffix(f'.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump(catalog, fh, ensure_ascii=False)
+    os.replace(tmp_path, catalog_path)
+    return catalog
+
+def _iter_content_lines(fh):
+    # Unfolds RFC 5545 content lines while reading. Folds are joined as bytes
+    # because a fold may split a multi-byte UTF-8 sequence.
+    pending = None
+    for raw in fh:
+        raw = raw.rstrip(b'\r\n')
+        if raw[:1] in (b' ', b'\t'):
+            if pending is not None:
+                pending.append(raw[1:])
+            continue
+        if pending is not None:
+            yield b''.join(pending).decode('utf-8-sig', 'replace')
+        pending = [raw] if raw else None
+    if pending is not None:
+        yield b''.join(pending).decode('utf-8-sig', 'replace')
+
+def _iter_vevents(ical_path):
+    # Yields the unfolded top-level content lines of each VEVENT, one event at a time
+    with open(ical_path, 'rb') as fh:
+        event = None
+        nested = 0
+        tz_lines = None
+        for line in _iter_content_lines(fh):
+            head = line[:16].upper()
+            if tz_lines is not None:
+                tz_lines.append(line)
+                if head.startswith('END:VTIMEZONE'):
+                    # Parsing a VTIMEZONE registers it with icalendar so TZIDs that
+                    # are not IANA names resolve the same way as in a full parse
+                    icalendar.Timezone.from_ical("\r\n".join(tz_lines))
+                    tz_lines = None
+                continue
+            if event is None:
+                if head.startswith('BEGIN:VEVENT'):
+                    event = []
+                elif head.startswith('BEGIN:VTIMEZONE'):
+                    tz_lines = [line]
+                continue
+            if head.startswith('BEGIN:'):
+                nested += 1
+            elif head.startswith('END:'):
+                if nested:
+                    nested -= 1
+                else:
+                    yield event
+                    event = None
+            elif not nested:
+                event.append(line)
+
+_types_factory = icalendar.prop.TypesFactory()
+_DATETIME_PROPERTIES = ('DTSTART', 'DTEND')
+
+class _Event:
+    # Property access for one streamed VEVENT, decoded the same way
+    # icalendar.Component.from_ical decodes them
+    __slots__ = ('_raw',)
+
+    def __init__(self, lines):
+        self._raw = {}
+        for line in lines:
+            try:
+                name, params, value = icalendar.parser.Contentline(line).parts()
+            except ValueError:
+                # icalendar.Event ignores lines it cannot parse, so does the stream
+                continue
+            self._raw.setdefault(name.upper(), (params, value))
+
+    def get(self, name):
+        if name not in self._raw:
+            return None
+        params, value = self._raw[name]
+        factory = _types_factory.for_property(name)
+        if name in _DATETIME_PROPERTIES and 'TZID' in params:
+            return factory(factory.from_ical(value, params['TZID']))
+        return factory(factory.from_ical(value))
+
+def iter_slots(ical_path):
+    # Streams the ICS file and yields one WiseSlot per VEVENT as it is read
+    for lines in _iter_vevents(ical_path):
+        yield _slot_from_event(_Event(lines))
+
+def _fallback_slot(event):
+    return WiseSlot(
+        course=str(event.get('SUMMARY')).capitalize() + " (Fallback)",
+        location=str(event.get('LOCATION')),
+        start_time=event.get('DTSTART').dt,
+        end_time=event.get('DTEND').dt,
+        ctype="Unknown",
+        ctype_abbr="UN",
+        lecturer="Unknown",
+    )
+
+_CTYPE_MAP = {
+    'PR': 'Predavanje',
+    'SV': 'Seminarske vaje',
+    'LV': 'Laboratorijske vaje',
+    'SE': 'Seminar',
+    'RV': 'Računalniške vaje'
+}
+_ABBR_IGNORE = frozenset(['in'])
+_LECTURER_INDICATORS = frozenset(['dr', 'prof', 'doc', 'asist', 'demonstrator'])
+_GROUP_INDICATORS = frozenset(['sk', 'erasmus', 'rv', 'vs', 'un', 'mag', 'izb'])
+
+# A semester repeats the same courses and description tails hundreds of times,
+# so both are classified once per distinct value.
+@functools.lru_cache(maxsize=4096)
+def _course_abbr(course):
+    return "".join([word[0] for word in course.split(" ") if word and word.lower() not in _ABBR_IGNORE]).upper()
+
+@functools.lru_cache(maxsize=16384)
+def _classify_tail(tail):
+    # tail is the DESCRIPTION after course name and type: "lecturer, ..., group, ..."
+    lecturers = []
+    groups = []
+    groups_started = False
+    lecutrers_and_groups = tail.split(", ")
+
+    # We need to heuristically separate lecturers and groups from the remaining parts
+    # Assumptions:
+    # - The first part is always a lecturer
+    # - The last part is always a group
+    # - After the first part, once we start seeing groups, all subsequent parts are groups
+    # - Groups often contain digits or specific keywords
+    for i, part in enumerate(lecutrers_and_groups):
+        # First part is always lecturer
+        if i == 0:
+            lecturers.append(part.title())
+            # print(f"First part, adding lecturer: {part.title()}")
+            continue
+        # Last part is always group or groups started
+        if i == len(lecutrers_and_groups) - 1 or groups_started:
+            groups.append(part)
+            # print(f"Adding group: {part}")
+            continue
+
+        # Now decide based on content
+        units = part.replace('.', '').lower().split(' ')
+        # If we find a digit, we assume it's a group
+        if any(char.isdigit() for char in part):
+            groups_started = True
+            groups.append(part)
+            # print(f"Found digit, adding group: {part}")
+            continue
+
+        # Check for common lecturer indicators
+        if any(unit in _LECTURER_INDICATORS for unit in units):
+            lecturers.append(part.title())
+            # print(f"Found lecturer indicator, adding lecturer: {part.title()}")
+            continue
+
+        # Check for common group indicators
+        if any(unit in _GROUP_INDICATORS for unit in units):
+            groups_started = True
+            groups.append(part)
+            # print(f"Found group indicator, adding group: {part}")
+            continue
+
+        # If there's only one word, assume it's a group
+        if len(units) == 1:
+            groups_started = True
+            groups.append(part)
+            # print(f"Single unit, assuming group, adding: {part}")
+            continue
+
+        # Default to lecturer if none of the above matched
+        lecturers.append(part.title())
+        # print(f"Defaulting to lecturer, adding: {part.title()}")
+
+    return ", ".join(lecturers), tuple(group.strip() for group in groups)
+
+def classifier_stats():
+    info = _classify_tail.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+
+def _slot_from_event(event):
+    course = str(event.get('SUMMARY')).capitalize()
+    dparts = str(event.get('DESCRIPTION')).split(", ")
+    if len(dparts) < 4:
+        print(f"Warning: DESCRIPTION field does not have enough parts: '{event.get('DESCRIPTION')}'")
+        return _fallback_slot(event)
+    if course != dparts[0].capitalize():
+        print(f"Warning: SUMMARY and DESCRIPTION course names do not match: '{course}' != '{dparts[0].capitalize()}'")
+        return _fallback_slot(event)
+    course_abbr = _course_abbr(course)
+    ctype_abbr = dparts[1]
+    lecturer, groups = _classify_tail(", ".join(dparts[2:]))
+    return WiseSlot(
+        course=course,
+        course_abbr=course_abbr,
+        ctype=_CTYPE_MAP.get(ctype_abbr, ctype_abbr),
+        ctype_abbr=ctype_abbr,
+        groups=groups,
+        location=str(event.get('LOCATION')),
+        lecturer=lecturer,
+        start_time=event.get('DTSTART').dt,
+        end_time=event.get('DTEND').dt,
+    )
+
+SlotDiff = collections.namedtuple('SlotDiff', ['added', 'removed'])
+
+def diff_slots(old_slots, new_slots):
+    # Event-level difference between two versions of a timetable
+    old_set = set(old_slots)
+    new_set = set(new_slots)
+    return SlotDiff(added=new_set - old_set, removed=old_set - new_set)
+
+def get_session_filters(slots):
+    return [tuple(f) for f in build_catalog(slots)['filters']]
 
 
 
 import yaml
-import json
 if __name__ == "__main__":
-    slots = get_slots('calendar(2).ics')
+    # python wise_tt.py TIMETABLE.ics, e.g. one written by benchmarks/synthetic_ics.py
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} TIMETABLE.ics")
+        sys.exit(1)
+    slots = list(iter_slots(sys.argv[1]))
     # for slot in slots:
     #     print(f"{slot.course} ({slot.ctype}) by {slot.lecturer} at {slot.location} from {slot.start_time} to {slot.end_time}, Groups: {', '.join(slot.groups)} Hash: {slot.hash()}")
     # filters = get_session_filters(slots)
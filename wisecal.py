@@ -5,11 +5,11 @@ import os
 import flask
 from flask import request
 from werkzeug.middleware.proxy_fix import ProxyFix
-import yaml
 import gcal
 import json
 import re
 import logging
+import hashlib
 
 import google.oauth2.id_token
 import google_auth_oauthlib.flow
@@ -19,7 +19,14 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import wise_tt
-import wisecal_cron
+import wisecal_worker
+import browser_pool
+import http_pool
+import metrics
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -55,18 +62,106 @@ if TRUSTED_PROXY_COUNT > 0:
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'WiseCal-CHANGE-THIS')
 
 
+# Set to 0 when syncing is left to standalone wisecal_worker.py processes
+RUN_SCHEDULER = os.environ.get('WISECAL_RUN_SCHEDULER', '1') == '1'
 scheduler = BackgroundScheduler()
 LJUBLJANA_TZ = ZoneInfo('Europe/Ljubljana')
 last_check_time = None
+# The scheduler syncs only the shards this process holds leases on, so several
+# replicas (and standalone workers) never sync the same timetable at once
+sync_worker = wisecal_worker.ShardWorker()
 
 def wisecal_sync_task():
     global last_check_time
-    calendar_updated = wisecal_cron.main()
+    calendar_updated = sync_worker.run_pass()
     last_check_time = datetime.now(LJUBLJANA_TZ)
 
-sync_job = scheduler.add_job(wisecal_sync_task, 'interval', minutes=15, max_instances=1)
-logger.info("Starting background scheduler for calendar sync...")
-scheduler.start()
+# Sync jobs waiting in or run by the scheduler, the periodic pass and requested user syncs
+metrics.Gauge('wisecal_scheduler_jobs', 'Jobs in the background scheduler', fn=lambda: len(scheduler.get_jobs()))
+
+# Prometheus metrics are served on their own port, like by standalone workers,
+# so they are never exposed on the public app. 0 disables them.
+METRICS_PORT = int(os.environ.get('WISECAL_METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('WISECAL_METRICS_HOST', '0.0.0.0')
+if METRICS_PORT:
+  metrics.serve(METRICS_PORT, METRICS_HOST)
+  logger.info(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}")
+
+sync_job = None
+if RUN_SCHEDULER:
+  sync_job = scheduler.add_job(wisecal_sync_task, 'interval', seconds=wisecal_worker.SYNC_INTERVAL, max_instances=1)
+  logger.info("Starting background scheduler for calendar sync...")
+  sync_worker.start()
+  scheduler.start()
+else:
+  logger.info("Background scheduler disabled, calendars are synced by wisecal_worker.py")
+
+def request_user_sync(email):
+  # Syncs only this user, from the cached timetable. The runner holding the
+  # user's timetable shard picks the request up, right away when it is us.
+  gcal.request_sync(email)
+  if sync_job is not None:
+    scheduler.add_job(sync_worker.run_requested_sync, args=[email], id=f'sync_user:{email}', replace_existing=True)
+    logger.info(f"Scheduled sync for {email}")
+
+# Timetable previews for /configure are downloaded in the background so web
+# threads never wait on Wise TT. Requests for the same timetable share one download.
+PREVIEW_WORKERS = int(os.environ.get('WISECAL_PREVIEW_WORKERS', '2'))
+# Failed previews are shown to everyone waiting on them, then downloaded again
+PREVIEW_FAILED_TTL = 60  # seconds
+preview_pool = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix='tt-preview')
+preview_jobs = {}
+preview_lock = threading.Lock()
+
+def timetable_path(schoolcode, filterId):
+  return gcal.BASE_DATA_DIR / 'calendars' / f"{schoolcode}_{filterId}.ics"
+
+def download_preview(schoolcode, filterId):
+  cal_fn = timetable_path(schoolcode, filterId)
+  preview_fn = cal_fn.with_suffix('.preview.ics')
+  try:
+    logger.info(f"Downloading timetable preview: {schoolcode}, {filterId}")
+    wise_tt.download_ical({'schoolcode': schoolcode, 'filterId': filterId}, preview_fn, cached_path=cal_fn)
+    # The sync job may have downloaded it in the meantime
+    if cal_fn.exists():
+      wise_tt.remove_ical(preview_fn)
+    else:
+      # Parsed here too, so the configuration page only has to read the catalog
+      wise_tt.get_catalog(preview_fn)
+      wise_tt.rename_ical(preview_fn, cal_fn)
+  except Exception:
+    wise_tt.remove_ical(preview_fn)
+    raise
+  finally:
+    with preview_lock:
+      preview_jobs[(schoolcode, filterId)]['finished'] = time.monotonic()
+
+def preview_job(schoolcode, filterId, start=True):
+  # Current download of the timetable, started if needed and start is set
+  key = (schoolcode, filterId)
+  with preview_lock:
+    job = preview_jobs.get(key)
+    if job is not None and job['finished'] is not None:
+      failed = job['future'].exception() is not None
+      if not failed or time.monotonic() - job['finished'] > PREVIEW_FAILED_TTL:
+        del preview_jobs[key]
+        job = None
+    if job is None and start and not timetable_path(schoolcode, filterId).exists():
+      job = {'finished': None}
+      preview_jobs[key] = job
+      job['future'] = preview_pool.submit(download_preview, schoolcode, filterId)
+    return job
+
+def shutdown_scheduler():
+  if RUN_SCHEDULER:
+    logger.info("Shutting down background scheduler...")
+    scheduler.shutdown(wait=True)
+    sync_worker.stop()
+  # Previews run in every web process, also without the scheduler
+  preview_pool.shutdown(wait=False, cancel_futures=True)
+  browser_pool.shutdown_pool()
+
+atexit.register(shutdown_scheduler)
 
 @app.route('/')
 def index():
@@ -78,13 +173,10 @@ def index():
     calendar_enabled = False
     last_update_time = None
   else:
-    try:
-      calendar_enabled = gcal.get_calendar_enabled(email)
-      has_settings = True
-      last_update_time = gcal.get_last_update_time(email)
-    except FileNotFoundError:
-      has_settings = False
-      calendar_enabled = False
+    status = gcal.get_user_status(email)
+    has_settings = status['has_settings']
+    calendar_enabled = status['enabled']
+    last_update_time = status['last_update_time']
 
   return flask.render_template('index.html',
                 email=email,
@@ -94,6 +186,25 @@ def index():
                 calendar_enabled=calendar_enabled,
                 )
 
+@app.route('/status')
+def status():
+  # Polled by index.html, answered from the in-memory status cache
+  email = flask.session.get('email')
+  if not email:
+    return flask.jsonify({'error': 'unauthorized'}), 401
+  status = gcal.get_user_status(email)
+  response = flask.jsonify({
+    'email': email,
+    'has_settings': status['has_settings'],
+    'calendar_enabled': status['enabled'],
+    'last_check_time': last_check_time.isoformat() if last_check_time else None,
+    'last_update_time': status['last_update_time'].isoformat() if status['last_update_time'] else None,
+  })
+  # The page revalidates on every poll, unchanged status costs a bodyless 304
+  response.set_etag(hashlib.sha256(response.get_data()).hexdigest()[:32])
+  response.headers['Cache-Control'] = 'private, no-cache'
+  return response.make_conditional(request)
+
 @app.route('/authorize')
 def authorize():
   # Create flow instance to manage the OAuth 2.0 Authorization Grant Flow steps.
@@ -171,18 +282,16 @@ def oauth2callback():
   
   decoded = google.oauth2.id_token.verify_oauth2_token(
       flow.credentials.id_token,
-      google.auth.transport.requests.Request(),
+      http_pool.auth_request,
       flow.credentials.client_id
   )
   flask.session['email'] = decoded['email']
   logger.info(f"User logged in: {decoded['email']}")
-  cred_fn = gcal.BASE_DATA_DIR / 'credentials' / f"{decoded['email']}.json"
   if flow.credentials.refresh_token is not None:
-    with open(cred_fn, 'w') as fh:
-      fh.write(flow.credentials.to_json())
+    gcal.save_credentials(decoded['email'], flow.credentials.to_json())
     logger.info(f"Saved credentials for: {decoded['email']}")
   else:
-    if not cred_fn.exists():
+    if not gcal.has_credentials(decoded['email']):
       logger.warning(f"OAuth callback: no refresh token and no existing credentials for {decoded['email']}")
       # Redirect to authorize with consent prompt to get refresh token
       return flask.redirect(flask.url_for('authorize', prompt='consent'))
@@ -203,12 +312,10 @@ def setup():
   
   # Check if user already has configured calendar
   existing_settings = None
-  settings_fn = gcal.BASE_DATA_DIR / 'settings' / f"{email}.yaml"
-  if settings_fn.exists():
-    try:
-      existing_settings = yaml.safe_load(open(settings_fn, 'r'))
-    except:
-      pass
+  try:
+    existing_settings = gcal.load_settings(email)
+  except:
+    pass
   
   return flask.render_template('setup.html', existing_settings=existing_settings)
 
@@ -254,7 +361,6 @@ def configure():
         'enabled': True,
         'owner': email,
         'title': title,
-        'force_sync': True,
         'timetable': {
           'schoolcode': schoolcode,
           'filterId': filterId
@@ -297,34 +403,33 @@ def configure():
         i('start_offset')
         i('end_offset')
 
-    settings_fn = gcal.BASE_DATA_DIR / 'settings' / f"{email}.yaml"
-    with open(settings_fn, 'w') as fh:
-      yaml.safe_dump(settings, fh)
+    gcal.save_settings(email, settings)
     logger.info(f"Configuration saved for {email}: {title} ({schoolcode}, {filterId})")
-    sync_job.modify(next_run_time=datetime.now())
-    logger.info(f"Scheduled immediate sync because of new configuration for {email}")
+    request_user_sync(email)
     return flask.render_template('success.html', title=title)
 
-  cal_fn = gcal.BASE_DATA_DIR / 'calendars' / f"{schoolcode}_{filterId}.ics"
+  cal_fn = timetable_path(schoolcode, filterId)
 
   if not cal_fn.exists():
-    try:
-      logger.info(f"Downloading timetable for {email}: {schoolcode}, {filterId}")
-      wise_tt.download_ical(
-          {'schoolcode': schoolcode, 'filterId': filterId},
-          cal_fn
-      )
-    except Exception as e:
+    job = preview_job(schoolcode, filterId)
+    if job is not None and job['future'].done() and job['future'].exception() is not None:
+      e = job['future'].exception()
       logger.error(f"Error downloading timetable for {email}: {str(e).splitlines()[0].strip()}")
       return flask.render_template('error.html',
         message='Napaka pri prenosu urnika.',
         details=str(e),
         help_tips=['Preverite, da je šifra šole pravilna', 'Preverite, da je Filter ID pravilen', 'Poskusite znova čez nekaj minut'],
         back_url='/setup', back_text='Nazaj na nastavitve')
+    if not cal_fn.exists():
+      return flask.render_template('loading.html',
+                                   title=title,
+                                   schoolcode=schoolcode,
+                                   filterId=filterId)
 
   try:
-    slots = wise_tt.get_slots(cal_fn)
-    logger.info(f"Loaded {len(slots)} slots for {email}")
+    # Courses and groups come from the timetable's catalog, built once per timetable version
+    catalog = wise_tt.get_catalog(cal_fn)
+    logger.info(f"Loaded catalog of {catalog['slots']} slots for {email}")
   except Exception as e:
     return flask.render_template('error.html',
       message='Napaka pri branju urnika.',
@@ -332,37 +437,27 @@ def configure():
       help_tips=['Preverite, da je šifra šole pravilna (npr. um_feri)', 'Preverite, da je Filter ID pravilen', 'Prepričajte se, da ima urnik aktivne termine'],
       back_url='/setup', back_text='Nazaj na nastavitve')
 
-  if len(slots) == 0:
+  if catalog['slots'] == 0:
     return flask.render_template('error.html',
       message='V urniku ni najdenih terminov.',
       details='Za podane podatke ni bilo mogoče najti nobenega termina.',
       help_tips=['Preverite, da je šifra šole pravilna (npr. um_feri)', 'Preverite, da je Filter ID pravilen', 'Prepričajte se, da ima urnik aktivne termine'],
       back_url='/setup', back_text='Nazaj na nastavitve')
 
-  pr_groups = sorted(set([g for slot in slots if slot.ctype_abbr == 'PR' for g in slot.groups]))
-  rv_groups = sorted(set([g for slot in slots if slot.ctype_abbr != 'PR' for g in slot.groups]))
-
-  course_names = sorted(set([(slot.course, slot.course_abbr) for slot in slots]))
-  courses = []
-  for cn in course_names:
-    courses.append({
-      'name': cn[0],
-      'id': cn[1],
-      'pr_groups': sorted(set([g for slot in slots if slot.course_abbr == cn[1] and slot.ctype_abbr == 'PR' for g in slot.groups])),
-      'rv_groups': sorted(set([g for slot in slots if slot.course_abbr == cn[1] and slot.ctype_abbr != 'PR' for g in slot.groups]))
-    })
+  pr_groups = catalog['pr_groups']
+  rv_groups = catalog['rv_groups']
+  courses = catalog['courses']
 
-  flask.session['courses'] = [c[1] for c in course_names]
+  flask.session['courses'] = [c['id'] for c in courses]
 
   # Load existing settings for prefilling form if available
   existing_format = {}
-  settings_fn = gcal.BASE_DATA_DIR / 'settings' / f"{email}.yaml"
-  if settings_fn.exists():
-    try:
-      existing_settings = yaml.safe_load(open(settings_fn, 'r'))
+  try:
+    existing_settings = gcal.load_settings(email)
+    if existing_settings is not None:
       existing_format = existing_settings.get('format', {})
-    except:
-      pass
+  except:
+    pass
 
   return flask.render_template('configure.html',
                                title=title,
@@ -374,6 +469,23 @@ def configure():
                                existing_format=existing_format)
 
   
+@app.route('/configure/status')
+def configure_status():
+  # Polled by loading.html until the preview download has finished
+  if not flask.session.get('email'):
+    return flask.jsonify({'status': 'unauthorized'}), 401
+  schoolcode = request.args.get('schoolcode', '')
+  filterId = request.args.get('filterId', '')
+  if not re.match(r'^[a-z_]{1,20}$', schoolcode) or not re.match(r'^[\d,;]{1,40}$', filterId):
+    return flask.jsonify({'status': 'invalid'}), 400
+  if timetable_path(schoolcode, filterId).exists():
+    return flask.jsonify({'status': 'ready'})
+  job = preview_job(schoolcode, filterId, start=False)
+  if job is None or job['future'].done():
+    # Failed, or gone: /configure reports the error or starts a new download
+    return flask.jsonify({'status': 'failed'})
+  return flask.jsonify({'status': 'pending'})
+
 @app.route('/sync/<start_stop>')
 def toggle_sync(start_stop):
   email = flask.session.get('email')
@@ -394,6 +506,9 @@ def toggle_sync(start_stop):
 
   try:
     gcal.set_calendar_enabled(email, enabled)
+    if enabled:
+      # The timetable may have changed while syncing was stopped
+      request_user_sync(email)
   except FileNotFoundError:
     return flask.render_template('error.html',
       message='Koledar ni nastavljen.',
@@ -1,9 +1,16 @@
 import gcal
 import wise_tt
-import yaml
-import filecmp
+import polling
+import metrics
+import browser_pool
 import logging
 import copy
+import os
+import threading
+import collections
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from google.auth.exceptions import RefreshError
 
 # Configure logging
@@ -13,110 +20,235 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def sync_slots(slots, settings):
-    owner = settings['calendar']['owner']
-    synced_slots = set(gcal.load_synced_event_ids(owner))
-    format_settings = settings['format']
-    slots_fmt = [slot.to_gcal(format_settings) for slot in slots]
-    slots_fmt = [slot for slot in slots_fmt if slot is not None]
-    new_ids = set([slot['id'] for slot in slots_fmt])
+DOWNLOAD_WORKERS = int(os.getenv('WISECAL_DOWNLOAD_WORKERS', '8'))
+DOWNLOADS_PER_SCHOOL = int(os.getenv('WISECAL_DOWNLOADS_PER_SCHOOL', '2'))
+SYNC_WORKERS = int(os.getenv('WISECAL_SYNC_WORKERS', '4'))
+# Event IDs from the session's identity instead of its rendered content, changed
+# events are then patched in place rather than deleted and inserted again
+STABLE_EVENT_IDS = os.getenv('WISECAL_STABLE_EVENT_IDS', '0') == '1'
+
+# Decides which timetables are downloaded in each pass
+poller = polling.Poller(gcal.BASE_DATA_DIR / 'calendars')
+
+# Users are synced concurrently, their calendar API batches share gcal's batch pool
+_sync_pool = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix='user-sync')
+
+_user_sync_seconds = metrics.Histogram('wisecal_user_sync_seconds', "Syncing one user's calendar")
+_user_sync_failures = metrics.Counter('wisecal_user_sync_failures_total', 'User syncs that raised an error')
+_pass_seconds = metrics.Histogram('wisecal_cron_pass_seconds', 'Sync passes over all due timetables',
+                                  buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800))
+_pass_failures = metrics.Counter('wisecal_cron_pass_failures_total', 'Sync passes that raised an error')
+_last_success = metrics.Gauge('wisecal_cron_last_success_timestamp_seconds', 'Unix time the last sync pass completed')
+_timetables_due = metrics.Gauge('wisecal_cron_timetables_due', 'Timetables downloaded in the last sync pass')
+
+class RenderCache:
+    # Users of the same timetable often share format settings (most keep the
+    # defaults), so rendered events are computed once per format fingerprint.
+    # Only callers waiting for the same fingerprint block each other.
+    def __init__(self, slots, changes=None):
+        self.slots = slots
+        self.changes = changes
+        self._rendered = {}
+        self._rendered_changes = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, cache, format_settings, render):
+        fingerprint = wise_tt.format_fingerprint(format_settings)
+        with self._lock:
+            future = cache.get(fingerprint)
+            owner = future is None
+            if owner:
+                future = cache[fingerprint] = Future()
+        if owner:
+            try:
+                future.set_result(render(format_settings))
+            except BaseException as e:
+                # Waiting callers get the error, later ones render again
+                with self._lock:
+                    del cache[fingerprint]
+                future.set_exception(e)
+        return future.result()
+
+    def get(self, format_settings):
+        return self._cached(self._rendered, format_settings, self._render)
+
+    def get_changes(self, format_settings):
+        # Events of added slots and IDs that no longer belong to any slot, content IDs only
+        return self._cached(self._rendered_changes, format_settings, self._render_changes)
+
+    def _render(self, format_settings):
+        events = wise_tt.FormatPlan(format_settings, stable_ids=STABLE_EVENT_IDS).render_all(self.slots)
+        return events, {event['id']: _content_hash(event) for event in events}
+
+    def _render_changes(self, format_settings):
+        plan = wise_tt.FormatPlan(format_settings)
+        added = plan.render_all(self.changes.added)
+        removed = plan.render_all(self.changes.removed)
+        removed_ids = {event['id'] for event in removed} - {event['id'] for event in added}
+        if removed_ids:
+            # A removed slot can render to the same event as an unchanged one when
+            # the format hides what differs between them. Such events start at the
+            # same time after per-rule offsets, so only slots starting then are checked
+            starts = {event['start']['dateTime'] for event in removed if event['id'] in removed_ids}
+            candidates = [slot for slot in self.slots if plan.start_time(slot).isoformat() in starts]
+            removed_ids -= {event['id'] for event in plan.render_all(candidates)}
+        return added, frozenset(removed_ids)
+
+def _content_hash(event):
+    # Without stable IDs the event ID already is the content hash
+    return wise_tt.event_content_hash(event) if STABLE_EVENT_IDS else event['id']
+
+_owner_locks = collections.defaultdict(threading.Lock)
+_owner_locks_lock = threading.Lock()
 
-    synced = []
+def _owner_lock(owner):
+    # Targeted and periodic syncs of the same user must not interleave
+    with _owner_locks_lock:
+        return _owner_locks[owner]
+
+def plan_sync(synced_events, render_cache, format_settings, changes=None):
+    # Compares the rendered timetable with a user's synced events and returns
+    # the unchanged synced events, events to insert, events to patch and IDs to delete
+    synced = {}
     to_insert = []
+    to_patch = []
     to_delete = []
 
-    for slot in slots_fmt:
-        if slot['id'] in synced_slots:
-            synced.append(slot['id'])
-        else:
-            to_insert.append(slot)
-    for slot_id in synced_slots:
-        if slot_id not in new_ids:
-            to_delete.append(slot_id)
+    if changes is not None and synced_events and not STABLE_EVENT_IDS:
+        # Shared between users, must not be modified
+        added, removed_ids = render_cache.get_changes(format_settings)
+        to_delete = [slot_id for slot_id in removed_ids if slot_id in synced_events]
+        synced = {slot_id: synced_events[slot_id] for slot_id in synced_events.keys() - removed_ids}
+        to_insert = [slot for slot in added if slot['id'] not in synced_events]
+    else:
+        # Shared between users, must not be modified
+        slots_fmt, new_hashes = render_cache.get(format_settings)
+        for slot in slots_fmt:
+            slot_id = slot['id']
+            if slot_id not in synced_events:
+                to_insert.append(slot)
+            elif STABLE_EVENT_IDS and synced_events[slot_id][0] != new_hashes[slot_id]:
+                to_patch.append(slot)
+            else:
+                synced[slot_id] = synced_events[slot_id]
+        for slot_id in synced_events:
+            if slot_id not in new_hashes:
+                to_delete.append(slot_id)
+    return synced, to_insert, to_patch, to_delete
+
+def sync_slots(slots, settings, render_cache=None, changes=None, timetable_digest=None) -> bool:
+    # Whether the user's calendar matches the timetable afterwards
+    with _owner_lock(settings['calendar']['owner']):
+        try:
+            with _user_sync_seconds.time():
+                return _sync_slots(slots, settings, render_cache, changes, timetable_digest)
+        except Exception:
+            _user_sync_failures.inc()
+            raise
+
+def _sync_slots(slots, settings, render_cache=None, changes=None, timetable_digest=None):
+    # With changes (a wise_tt.SlotDiff against the timetable the user's calendar
+    # was last synced to) only the changed events are rendered and compared
+    owner = settings['calendar']['owner']
+    synced_events = gcal.load_synced_events(owner)
+    if render_cache is None:
+        render_cache = RenderCache(slots, changes)
 
-    if len(to_insert) == 0 and len(to_delete) == 0:
+    synced, to_insert, to_patch, to_delete = plan_sync(synced_events, render_cache, settings['format'], changes)
+
+    if len(to_insert) == 0 and len(to_patch) == 0 and len(to_delete) == 0:
         logger.debug(f"No changes to sync for {owner}")
-        return
+        gcal.set_synced_timetable(owner, timetable_digest)
+        return True
 
-    logger.info(f"Syncing for {owner}: {len(to_insert)} to insert, {len(to_delete)} to delete, {len(synced)} unchanged")
+    logger.info(f"Syncing for {owner}: {len(to_insert)} to insert, {len(to_patch)} to patch, {len(to_delete)} to delete, {len(synced)} unchanged")
 
     try:
-        service = gcal.get_cal_service(owner)
+        creds = gcal.get_credentials(owner)
     except RefreshError as e:
         logger.error(f"Failed to refresh credentials for {owner}: {e}")
+        gcal.invalidate_service(owner)
         gcal.set_calendar_enabled(owner, False)
-        return
+        return False
+    service = gcal.get_cal_service(owner, creds)
 
     cal_id = gcal.get_cal_id(owner)
     if not cal_id:
         cal_id = gcal.create_calendar(owner, settings['calendar']['title'])
         logger.info(f"Created new calendar for {owner}: {cal_id}")
 
-    # Track successfully processed events
-    inserted_ids = []
+    events = {slot['id']: slot for slot in to_insert + to_patch}
+    calls = []
+    for slot in to_insert:
+        calls.append((('insert', slot['id']), service.events().insert(calendarId=cal_id, body=slot)))
+    for slot in to_patch:
+        body = {key: value for key, value in slot.items() if key != 'id'}
+        calls.append((('patch', slot['id']), service.events().patch(calendarId=cal_id, eventId=slot['id'], body=body)))
+    for slot_id in to_delete:
+        calls.append((('delete', slot_id), service.events().delete(calendarId=cal_id, eventId=slot_id)))
+    outcomes = gcal.execute_batched(service, creds, calls)
+
+    # Track successfully processed events as ID -> (content hash, etag)
+    written = {}
     deleted_ids = []
+    restore = []
     insert_errors = []
+    patch_errors = []
     delete_errors = []
-
-    def make_insert_callback(slot_id):
-        def callback(_, __, exception):
-            if exception is not None:
+    for (action, slot_id), outcome in outcomes.items():
+        exception = outcome.exception
+        status = exception.resp.status if exception is not None and hasattr(exception, 'resp') else None
+        if action == 'insert':
+            if exception is None:
+                written[slot_id] = (_content_hash(events[slot_id]), outcome.response.get('etag'))
+            elif status == 409:
+                # The ID exists from an earlier, unrecorded sync or stays taken by an
+                # event deleted before, which only becomes visible again with an update
+                restore.append(events[slot_id])
+            else:
                 insert_errors.append((slot_id, exception))
                 logger.error(f"Failed to insert event {slot_id}: {exception}")
+        elif action == 'patch':
+            if exception is None:
+                written[slot_id] = (_content_hash(events[slot_id]), outcome.response.get('etag'))
             else:
-                inserted_ids.append(slot_id)
-        return callback
-
-    def make_delete_callback(slot_id):
-        def callback(_, __, exception):
-            if exception is not None:
-                # 404 errors on delete are okay - event already gone
-                if hasattr(exception, 'resp') and exception.resp.status == 404:
-                    deleted_ids.append(slot_id)
-                else:
-                    delete_errors.append((slot_id, exception))
-                    logger.error(f"Failed to delete event {slot_id}: {exception}")
-            else:
+                patch_errors.append((slot_id, exception))
+                logger.error(f"Failed to patch event {slot_id}: {exception}")
+                # Events deleted by the user are forgotten and inserted again on the next sync
+                if status not in (404, 410):
+                    synced[slot_id] = synced_events[slot_id]
+        else:
+            # 404/410 errors on delete are okay - event already gone
+            if exception is None or status in (404, 410):
                 deleted_ids.append(slot_id)
-        return callback
-
-    BATCH_SIZE = 1000
-    insert_idx = 0
-    delete_idx = 0
-    while insert_idx < len(to_insert) or delete_idx < len(to_delete):
-        batch = service.new_batch_http_request()
-        batch_count = 0
-
-        # Add inserts to batch
-        while insert_idx < len(to_insert) and batch_count < BATCH_SIZE:
-            slot = to_insert[insert_idx]
-            batch.add(
-                service.events().insert(calendarId=cal_id, body=slot),
-                callback=make_insert_callback(slot['id'])
-            )
-            insert_idx += 1
-            batch_count += 1
-
-        # Add deletes to batch
-        while delete_idx < len(to_delete) and batch_count < BATCH_SIZE:
-            slot_id = to_delete[delete_idx]
-            batch.add(
-                service.events().delete(calendarId=cal_id, eventId=slot_id),
-                callback=make_delete_callback(slot_id)
-            )
-            delete_idx += 1
-            batch_count += 1
-
-        batch.execute()
-
-    # Update synced IDs: keep synced + successfully inserted - successfully deleted
-    final_synced_ids = set(synced) | set(inserted_ids)
-    final_synced_ids -= set(deleted_ids)
-    gcal.save_synced_event_ids(owner, list(final_synced_ids))
-    gcal.set_last_update_time(owner)
-
-    if insert_errors or delete_errors:
-        logger.warning(f"Sync completed for {owner} with errors: {len(insert_errors)} insert failures, {len(delete_errors)} delete failures")
+            else:
+                delete_errors.append((slot_id, exception))
+                logger.error(f"Failed to delete event {slot_id}: {exception}")
+                synced[slot_id] = synced_events[slot_id]
+
+    if restore:
+        calls = [(('update', slot['id']), service.events().update(calendarId=cal_id, eventId=slot['id'], body={**slot, 'status': 'confirmed'}))
+                 for slot in restore]
+        for (_, slot_id), outcome in gcal.execute_batched(service, creds, calls).items():
+            if outcome.exception is None:
+                written[slot_id] = (_content_hash(events[slot_id]), outcome.response.get('etag'))
+            else:
+                insert_errors.append((slot_id, outcome.exception))
+                logger.error(f"Failed to restore event {slot_id}: {outcome.exception}")
+
+    # Update synced events: keep synced + successfully written - successfully deleted
+    final_synced = synced | written
+    for slot_id in deleted_ids:
+        final_synced.pop(slot_id, None)
+    sync_failed = bool(insert_errors or patch_errors or delete_errors)
+    with gcal.transaction():
+        gcal.save_synced_events(owner, final_synced)
+        gcal.set_last_update_time(owner)
+        # After failures the calendar does not match the timetable, next sync has to be a full one
+        gcal.set_synced_timetable(owner, None if sync_failed else timetable_digest)
+
+    if sync_failed:
+        logger.warning(f"Sync completed for {owner} with errors: {len(insert_errors)} insert failures, {len(patch_errors)} patch failures, {len(delete_errors)} delete failures")
         
         # Check if calendar might be gone
         if gcal.check_calendar_exists(owner, cal_id) is False:
@@ -124,20 +256,142 @@ def sync_slots(slots, settings):
             gcal.set_calendar_enabled(owner, False)
             gcal.delete_calendar_id(owner)
     else:
-        logger.info(f"Sync completed for {owner}: {len(inserted_ids)} inserted, {len(deleted_ids)} deleted")
+        logger.info(f"Sync completed for {owner}: {len(written)} inserted or patched, {len(deleted_ids)} deleted")
+    return not sync_failed
+
+def _interleave_by_school(jobs):
+    # Round-robin over schools so a school waiting on its concurrency limit
+    # does not hold up download workers that could serve other schools
+    queues = [[(schoolcode, filterId) for filterId in jobs[schoolcode]] for schoolcode in jobs]
+    for i in range(max((len(q) for q in queues), default=0)):
+        for q in queues:
+            if i < len(q):
+                yield q[i]
+
+def _timetable_path(schoolcode, filterId):
+    return gcal.BASE_DATA_DIR / 'calendars' / f"{schoolcode}_{filterId}.ics"
+
+def download_timetable(schoolcode, filterId, school_limit, fence=None):
+    tt_filename = schoolcode + "_" + filterId
+    with school_limit:
+        if fence is not None and not fence(schoolcode, filterId):
+            # Lost to another runner while waiting, the download file is shared with it
+            return None
+        logger.debug(f"Downloading timetable: {schoolcode}, {filterId}")
+        return wise_tt.download_ical(
+            {'schoolcode': schoolcode, 'filterId': filterId},
+            gcal.BASE_DATA_DIR / 'calendars' / f"{tt_filename}.new.ics",
+            cached_path=gcal.BASE_DATA_DIR / 'calendars' / f"{tt_filename}.ics"
+        )
+
+def process_timetable(schoolcode, filterId, users, new_tt):
+    old_tt = _timetable_path(schoolcode, filterId)
+    has_force_sync = any(settings.get('calendar', {}).get('force_sync', False) for settings in users)
+    # download_ical returns the old file itself when the server answered 304 Not Modified
+    not_modified = new_tt == old_tt
+    # Normalized content digests ignore export timestamps, UIDs and event order
+    new_digest = wise_tt.content_digest(new_tt)
+    old_digest = wise_tt.content_digest(old_tt) if old_tt.exists() else None
+    is_same = not_modified or new_digest == old_digest
+    # If the old and new timetables are the same, delete the new one and continue
+    if not has_force_sync and is_same:
+        if not not_modified:
+            wise_tt.remove_ical(new_tt)
+        logger.debug(f"No changes in timetable: {schoolcode}, {filterId}")
+        return False
+
+    calendar_updated = False
+    slots = wise_tt.get_slots(new_tt)
+    # Stored with the timetable for /configure, from the slots already parsed here
+    catalog = wise_tt.get_catalog(new_tt, slots)
+    changes = None
+    if old_digest is not None and not is_same:
+        try:
+            changes = wise_tt.diff_slots(wise_tt.get_slots(old_tt), slots)
+            logger.info(f"Timetable diff: {schoolcode}, {filterId} - {len(changes.added)} added, {len(changes.removed)} removed")
+        except Exception as e:
+            logger.warning(f"Failed to diff timetable {schoolcode}, {filterId}, doing a full sync: {e}")
+    render_cache = RenderCache(slots, changes)
+    logger.info(f"Timetable changed: {schoolcode}, {filterId} - {len(slots)} slots, {len(catalog['courses'])} courses")
+    futures = {}
+    for settings in users:
+        force_sync = settings.get('calendar', {}).get('force_sync', False)
+        if is_same and not force_sync:
+            logger.debug(f"Skipping sync for {settings['calendar']['owner']} as there are no changes")
+            continue
+        # Incremental sync only applies to calendars that were synced to the previous version
+        user_changes = None
+        if changes is not None and not force_sync and gcal.get_synced_timetable(settings['calendar']['owner']) == old_digest:
+            user_changes = changes
+        future = _sync_pool.submit(sync_slots, slots, settings, render_cache, changes=user_changes, timetable_digest=new_digest)
+        futures[future] = settings
+    for future in as_completed(futures):
+        try:
+            future.result()
+            calendar_updated = True
+        except Exception as e:
+            logger.error(f"Error syncing slots for {futures[future]['calendar']['owner']}: {e}")
+
+    if not not_modified:
+        wise_tt.rename_ical(new_tt, old_tt)
+    return calendar_updated
 
-def main():
+class SyncDeferred(Exception):
+    # The user's timetable has not been downloaded yet, see sync_user
+    pass
+
+def sync_user(owner) -> bool:
+    # Syncs one user's calendar against the cached timetable, e.g. after they
+    # changed their settings, without touching any other user or timetable.
+    # Returns False when there is nothing to sync, raises SyncDeferred until
+    # the timetable is downloaded and an error when the sync did not complete.
+    settings = gcal.load_settings(owner)
+    if settings is None or not settings.get('calendar', {}).get('enabled', False):
+        logger.debug(f"Not syncing {owner}, calendar is not enabled")
+        return False
+    timetable = settings['calendar'].get('timetable', {})
+    schoolcode, filterId = timetable.get('schoolcode'), timetable.get('filterId')
+    if not schoolcode or not filterId:
+        logger.warning(f"Not syncing {owner} due to missing schoolcode or filterId")
+        return False
+    tt_path = _timetable_path(schoolcode, filterId)
+    if not tt_path.exists():
+        # Timetables that were never downloaded are due right away in the next pass
+        poller.trigger((schoolcode, filterId))
+        raise SyncDeferred(f"No cached timetable yet: {schoolcode}, {filterId}")
+    logger.info(f"Syncing {owner} after a settings change: {schoolcode}, {filterId}")
+    if not sync_slots(wise_tt.get_slots(tt_path), settings, timetable_digest=wise_tt.content_digest(tt_path)):
+        raise RuntimeError(f"Sync of {owner} did not complete")
+    return True
+
+def shard_of(schoolcode, filterId, shard_count: int) -> int:
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(f"{schoolcode}_{filterId}".encode('utf-8')) % shard_count
+
+def main(shards=None, fence=None):
+    # shards is (shard indices, shard count) to only process the timetables of
+    # those shards, see wisecal_worker.py. fence(schoolcode, filterId) is asked
+    # right before a timetable is downloaded and synced, a timetable it returns
+    # False for is left alone for the rest of the pass.
+    try:
+        with _pass_seconds.time():
+            calendar_updated = _main(shards, fence)
+    except Exception:
+        _pass_failures.inc()
+        raise
+    _last_success.set(time.time())
+    return calendar_updated
+
+def _main(shards=None, fence=None):
     logger.debug("Starting WiseCal cron job")
     gcal.ensure_dirs()
-    settings_dir = gcal.BASE_DATA_DIR / 'settings'
     jobs = {}
-    for settings_fn in settings_dir.glob('*.yaml'):
-        settings = yaml.safe_load(open(settings_fn, 'r'))
-        if settings.get('calendar', {}).get('enabled', False):
-            schoolcode = settings['calendar'].get('timetable', {}).get('schoolcode')
-            filterId = settings['calendar'].get('timetable', {}).get('filterId')
+    for (schoolcode, filterId), owners in gcal.settings_index.timetables().items():
+        if shards is not None and shard_of(schoolcode, filterId, shards[1]) not in shards[0]:
+            continue
+        for owner, settings in owners.items():
             if not schoolcode or not filterId:
-                logger.warning(f"Skipping settings file {settings_fn} due to missing schoolcode or filterId")
+                logger.warning(f"Skipping settings of {owner} due to missing schoolcode or filterId")
                 continue
             jobs.setdefault(schoolcode, {}).setdefault(filterId, []).append(settings)
             # Reset force_sync after use
@@ -145,52 +399,56 @@ def main():
                 logger.info(f"Force sync enabled for {settings['calendar']['owner']}")
                 new_settings = copy.deepcopy(settings)
                 new_settings['calendar']['force_sync'] = False
-                with open(settings_fn, 'w') as f:
-                    yaml.safe_dump(new_settings, f)
+                gcal.save_settings(owner, new_settings)
             
     
     total_users = sum(len(users) for sc in jobs.values() for users in sc.values())
     logger.debug(f"Found {total_users} enabled calendars to sync")
+
+    # Only timetables that are due are downloaded, force_sync ones always are
+    forced = {(schoolcode, filterId) for schoolcode in jobs for filterId, users in jobs[schoolcode].items()
+              if any(settings['calendar'].get('force_sync', False) for settings in users)}
+    due_jobs = {}
+    for schoolcode, filterId in poller.due([(schoolcode, filterId) for schoolcode in jobs for filterId in jobs[schoolcode]], forced):
+        due_jobs.setdefault(schoolcode, {})[filterId] = jobs[schoolcode][filterId]
+    jobs = due_jobs
+    _timetables_due.set(sum(len(filters) for filters in jobs.values()))
     
+    # Download stage runs concurrently, parse/sync consumes timetables as soon as they arrive
+    school_limits = {schoolcode: threading.Semaphore(DOWNLOADS_PER_SCHOOL) for schoolcode in jobs}
     calendar_updated = False
-    for schoolcode in jobs:
-        for filterId in jobs[schoolcode]:
-            tt_filename = schoolcode + "_" + filterId
-            logger.debug(f"Downloading timetable: {schoolcode}, {filterId}")
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='tt-download') as pool:
+        futures = {}
+        for schoolcode, filterId in _interleave_by_school(jobs):
+            future = pool.submit(download_timetable, schoolcode, filterId, school_limits[schoolcode], fence)
+            futures[future] = (schoolcode, filterId)
+        for future in as_completed(futures):
+            schoolcode, filterId = futures[future]
             try:
-                new_tt = wise_tt.download_ical(
-                    {'schoolcode': schoolcode, 'filterId': filterId},
-                    gcal.BASE_DATA_DIR / 'calendars' / f"{tt_filename}.new.ics"
-                )
+                new_tt = future.result()
             except Exception as e:
                 logger.error(f"Failed to download timetable for {schoolcode}, {filterId}: {str(e).splitlines()[0].strip()}")
+                poller.record((schoolcode, filterId), failed=True)
                 continue
-            old_tt = gcal.BASE_DATA_DIR / 'calendars' / f"{tt_filename}.ics"
-
-            has_force_sync = any(settings.get('calendar', {}).get('force_sync', False) for settings in jobs[schoolcode][filterId])
-            is_same = old_tt.exists() and filecmp.cmp(old_tt, new_tt)
-            # If the old and new files are the same, delete the new one and continue
-            if not has_force_sync and is_same:
-                new_tt.unlink()
-                logger.debug(f"No changes in timetable: {schoolcode}, {filterId}")
+            if new_tt is None or (fence is not None and not fence(schoolcode, filterId)):
+                # Synced by the runner that took over the timetable's shard
+                logger.info(f"Skipping timetable {schoolcode}, {filterId}, its shard is held by another runner")
+                if new_tt is not None and new_tt != _timetable_path(schoolcode, filterId):
+                    wise_tt.remove_ical(new_tt)
                 continue
-
-            slots = wise_tt.get_slots(new_tt)
-            logger.info(f"Timetable changed: {schoolcode}, {filterId} - {len(slots)} slots")
-            for settings in jobs[schoolcode][filterId]:
-                if is_same and not settings.get('calendar', {}).get('force_sync', False):
-                    logger.debug(f"Skipping sync for {settings['calendar']['owner']} as there are no changes")
-                    continue
-                try:
-                    sync_slots(slots, settings)
+            try:
+                if process_timetable(schoolcode, filterId, jobs[schoolcode][filterId], new_tt):
                     calendar_updated = True
-                except Exception as e:
-                    logger.error(f"Error syncing slots for {settings['calendar']['owner']}: {e}")
+                poller.record((schoolcode, filterId), wise_tt.content_digest(_timetable_path(schoolcode, filterId)))
+            except Exception as e:
+                logger.error(f"Failed to process timetable for {schoolcode}, {filterId}: {e}")
+                poller.record((schoolcode, filterId), failed=True)
 
-            new_tt.rename(old_tt)
-    
     logger.debug("WiseCal cron job completed")
     return calendar_updated
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        browser_pool.shutdown_pool()
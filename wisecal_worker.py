@@ -0,0 +1,219 @@
+import dotenv
+dotenv.load_dotenv()
+
+import gcal
+import storage
+import wisecal_cron
+import browser_pool
+import metrics
+import argparse
+import logging
+import math
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Timetables are split into SHARDS shards by wisecal_cron.shard_of. Every sync
+# runner (standalone workers and web processes running the scheduler) holds
+# leases on a fair share of the shards and only syncs timetables in them, so
+# no timetable is synced by two processes at once. With one shard this is
+# leader election. All runners must use the same number of shards.
+SHARDS = int(os.getenv('WISECAL_WORKER_SHARDS', '1'))
+LEASE_TTL = float(os.getenv('WISECAL_LEASE_TTL', '60'))  # seconds
+# Passes are cheap, each one only downloads the timetables the poller considers due
+SYNC_INTERVAL = float(os.getenv('WISECAL_SYNC_INTERVAL', '60'))  # seconds
+# How often a standalone worker looks for requested per-user syncs
+TICK = 5  # seconds
+# Failed and deferred requested syncs stay pending and are retried after a
+# delay that doubles with every attempt
+RETRY_MIN_DELAY = 30  # seconds
+RETRY_MAX_DELAY = 1800  # seconds
+
+# Reads the store, so not on every scrape
+metrics.Gauge('wisecal_sync_requests_pending', 'Requested per-user syncs not yet run', fn=lambda: len(gcal.pending_syncs()), ttl=30)
+_shards_held = metrics.Gauge('wisecal_worker_shards_held', 'Timetable shards this process holds leases on')
+
+class ShardWorker:
+    def __init__(self, shards: int = SHARDS, ttl: float = LEASE_TTL, holder: str = None):
+        self.shards = max(1, shards)
+        self.ttl = ttl
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leases = storage.LeaseTable(gcal.BASE_DATA_DIR / 'leases.sqlite3')
+        self.held = set()
+        # {owner: (attempts, monotonic time of the next attempt, request time)}
+        self._retries = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    def _shard_name(self, shard: int) -> str:
+        return f"shard:{shard}/{self.shards}"
+
+    def start(self):
+        # Registers this runner and keeps its leases alive from a background thread
+        self.leases.acquire(f"worker:{self.holder}", self.holder, self.ttl)
+        self._heartbeat = threading.Thread(target=self._renew_loop, name='worker-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def _renew_loop(self):
+        while not self._stopped.wait(self.ttl / 3):
+            self.leases.acquire(f"worker:{self.holder}", self.holder, self.ttl)
+            with self._lock:
+                for shard in list(self.held):
+                    if not self.leases.renew(self._shard_name(shard), self.holder, self.ttl):
+                        logger.warning(f"Lost lease on shard {shard}/{self.shards}")
+                        self.held.discard(shard)
+                _shards_held.set(len(self.held))
+
+    def rebalance(self) -> set:
+        # Runs between passes: gives up shards above the fair share so new
+        # runners get work, and takes free or expired shards up to it
+        workers = len(self.leases.holders('worker:')) or 1
+        fair_share = math.ceil(self.shards / workers)
+        with self._lock:
+            for shard in sorted(self.held, reverse=True)[:max(0, len(self.held) - fair_share)]:
+                self.leases.release(self._shard_name(shard), self.holder)
+                self.held.discard(shard)
+            for shard in range(self.shards):
+                if len(self.held) >= fair_share:
+                    break
+                if shard not in self.held and self.leases.acquire(self._shard_name(shard), self.holder, self.ttl):
+                    self.held.add(shard)
+            _shards_held.set(len(self.held))
+            return set(self.held)
+
+    def fence(self, schoolcode, filterId) -> bool:
+        # Whether the timetable's shard is still held, renewing its lease. Asked
+        # right before each timetable's writes, so a pass that outlives a lost
+        # lease leaves the shard's remaining timetables to its new holder.
+        shard = wisecal_cron.shard_of(schoolcode, filterId, self.shards)
+        with self._lock:
+            if shard not in self.held:
+                return False
+            if self.leases.renew(self._shard_name(shard), self.holder, self.ttl):
+                return True
+            logger.warning(f"Lost lease on shard {shard}/{self.shards}")
+            self.held.discard(shard)
+            _shards_held.set(len(self.held))
+            return False
+
+    def run_requested_syncs(self, owners=None) -> int:
+        # Syncs users queued with gcal.request_sync whose timetable is in a held
+        # shard, all of them or only those in owners. A request is completed once
+        # the user is synced or has nothing to sync.
+        synced = 0
+        for owner, requested in gcal.pending_syncs().items():
+            if owners is not None and owner not in owners:
+                continue
+            with self._lock:
+                retry = self._retries.get(owner)
+            # Newer requests are not held back by the backoff of a failed one
+            if retry is not None and retry[2] >= requested and time.monotonic() < retry[1]:
+                continue
+            settings = gcal.load_settings(owner)
+            if settings is not None:
+                timetable = settings.get('calendar', {}).get('timetable', {})
+                if not self.fence(timetable.get('schoolcode'), timetable.get('filterId')):
+                    # Left for the runner holding that shard
+                    continue
+                try:
+                    if wisecal_cron.sync_user(owner):
+                        synced += 1
+                except wisecal_cron.SyncDeferred as e:
+                    self._retry_later(owner, requested, retry)
+                    logger.info(f"Requested sync for {owner} deferred: {e}")
+                    continue
+                except Exception as e:
+                    delay = self._retry_later(owner, requested, retry)
+                    logger.error(f"Requested sync for {owner} failed, retrying in {delay:.0f}s: {e}")
+                    continue
+            gcal.complete_sync(owner, requested)
+            with self._lock:
+                self._retries.pop(owner, None)
+        return synced
+
+    def run_requested_sync(self, owner) -> bool:
+        # A sync requested in this process. Shards are taken first when no pass
+        # has run yet, the request would be left for another runner otherwise.
+        with self._lock:
+            holds_shards = bool(self.held)
+        if not holds_shards:
+            self.rebalance()
+        return self.run_requested_syncs({owner}) > 0
+
+    def _retry_later(self, owner, requested, retry) -> float:
+        attempts = retry[0] + 1 if retry is not None and retry[2] >= requested else 1
+        delay = min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** (attempts - 1))
+        with self._lock:
+            self._retries[owner] = (attempts, time.monotonic() + delay, requested)
+        return delay
+
+    def run_pass(self) -> bool:
+        held = self.rebalance()
+        if not held:
+            logger.debug(f"Worker {self.holder} holds no shards, standing by")
+            return False
+        logger.debug(f"Worker {self.holder} syncing shards {sorted(held)} of {self.shards}")
+        self.run_requested_syncs()
+        return wisecal_cron.main(shards=(held, self.shards), fence=self.fence)
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._lock:
+            for shard in self.held:
+                self.leases.release(self._shard_name(shard), self.holder)
+            self.held.clear()
+        self.leases.release(f"worker:{self.holder}", self.holder)
+
+    def run_forever(self, interval: float = SYNC_INTERVAL):
+        # Runs a pass every interval, requested per-user syncs every tick
+        next_run = 0
+        while not self._stopped.is_set():
+            try:
+                held = set(self.held)
+                # Picks up shards released by other workers or left by crashed ones
+                if not self.rebalance() <= held:
+                    next_run = 0
+                self.run_requested_syncs()
+                if time.monotonic() >= next_run:
+                    next_run = time.monotonic() + interval
+                    self.run_pass()
+            except Exception as e:
+                logger.error(f"Sync pass failed: {e}")
+            self._stopped.wait(TICK)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Standalone WiseCal sync worker')
+    parser.add_argument('--shards', type=int, default=SHARDS, help='Number of timetable shards, equal for all workers')
+    parser.add_argument('--interval', type=float, default=SYNC_INTERVAL, help='Seconds between sync passes')
+    parser.add_argument('--once', action='store_true', help='Run a single pass and exit')
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('WISECAL_METRICS_PORT', '0')), help='Serve Prometheus metrics on this port, 0 to disable')
+    parser.add_argument('--metrics-host', default=os.getenv('WISECAL_METRICS_HOST', '0.0.0.0'), help='Address the metrics port is bound to')
+    args = parser.parse_args()
+
+    gcal.ensure_dirs()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+        logger.info(f"Serving metrics on {args.metrics_host}:{args.metrics_port}")
+    worker = ShardWorker(shards=args.shards)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker._stopped.set())
+    worker.start()
+    logger.info(f"Worker {worker.holder} started with {worker.shards} shards")
+    try:
+        if args.once:
+            worker.run_pass()
+        else:
+            worker.run_forever(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+        browser_pool.shutdown_pool()
+        logger.info(f"Worker {worker.holder} stopped")